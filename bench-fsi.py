@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+''' benchmarks for fs_inspect
+
+    bench-fsi.py hash [--sizes 4K,1M,..] [--json]
+        compares the in-process file hashing of `fsi` (with every available
+        hash algorithm) with the former split between reading 32KB chunks
+        (small files) and running `sha1sum` (large files) and with hashing a
+        mmap'ed file
+
+    bench-fsi.py index [--files N] [--sizes 1K:60,64K:30,4M:10] [--json]
+        generates a synthetic file tree (see `generate_tree()`) and times
+        `indexer.add` on an empty index (cold) and again on the same index
+        (warm) as well as `diff` and `check_redundancy` with and without
+        `--from-index`. Page caches are not dropped - "cold" only refers to
+        the index
+
+    bench-fsi.py startup [--files N] [--repeat N] [--json]
+        times complete `fsi` invocations (interpreter start up included) of
+        cheap commands on a generated index, i.e. what a user waits for when
+        running a single query
+'''
+
+import os
+import sys
+import json
+import time
+import mmap
+import random
+import string
+import platform
+import contextlib
+import shutil
+import logging
+import hashlib
+import tempfile
+import argparse
+import functools
+import subprocess
+
+import fsi
+
+
+def legacy_internal(filename):
+    ''' former `sha1_internal()`: a new bytes object per 32KB chunk '''
+    _hash = hashlib.sha1()
+    with open(filename, 'rb') as _file:
+        for chunk in iter(functools.partial(_file.read, 2 ** 15), b''):
+            _hash.update(chunk)
+    return _hash.hexdigest()
+
+
+def legacy_external(filename):
+    ''' former `sha1_external()`: one `sha1sum` process per file '''
+    return subprocess.Popen(
+        ['sha1sum', filename],
+        stdout=subprocess.PIPE).communicate()[0].decode().split(' ')[0]
+
+
+def legacy_split(filename):
+    ''' former `file_info.fast_sha1()` '''
+    if os.path.getsize(filename) < 50000:
+        return legacy_internal(filename)
+    return legacy_external(filename)
+
+
+def mmap_hash(filename):
+    ''' hash a memory mapped file without copying it '''
+    _hash = hashlib.sha1()
+    with open(filename, 'rb') as _file:
+        _size = os.fstat(_file.fileno()).st_size
+        _chunk_size = fsi.hash_chunk_size(_size)
+        with mmap.mmap(_file.fileno(), 0, access=mmap.ACCESS_READ) as _map:
+            _view = memoryview(_map)
+            for _offset in range(0, _size, _chunk_size):
+                _hash.update(_view[_offset:_offset + _chunk_size])
+            _view.release()
+    return _hash.hexdigest()
+
+
+HASH_FUNCTIONS = {
+    'fsi-%s' % a: functools.partial(fsi.hash_file, algorithm=a)
+    for a in fsi.HASH_ALGORITHMS}
+HASH_FUNCTIONS.update({
+    'legacy-internal': legacy_internal,
+    'legacy-external': legacy_external,
+    'legacy-split': legacy_split,
+    'mmap': mmap_hash,
+})
+
+
+def parse_size(text):
+    _factors = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30}
+    if text[-1].upper() in _factors:
+        return int(text[:-1]) * _factors[text[-1].upper()]
+    return int(text)
+
+
+def parse_distribution(text):
+    ''' parses "1K:60,64K:30,4M" into [(1024, 60), (65536, 30), (4M, 1)] '''
+    _result = []
+    for _item in text.split(','):
+        _size, _, _weight = _item.partition(':')
+        _result.append((parse_size(_size), int(_weight or 1)))
+    return _result
+
+
+def generate_tree(root, files=1000, sizes=((2 ** 10, 1),), duplicates=0.2,
+                  depth=4, fanout=4, name_length=12, seed=0):
+    ''' creates <files> files below <root>/a and <root>/b (which makes `diff`
+        meaningful) with sizes drawn from <sizes> ([(size, weight), ..]). A
+        fraction of <duplicates> files are copies of files created earlier
+        anywhere in the tree. Directories are nested up to <depth> levels
+        with <fanout> subdirectories each, names have <name_length>
+        characters. The same parameters always produce the same tree.
+        Returns (file count, byte count)
+    '''
+    _rng = random.Random(seed)
+    _filler = bytes(_rng.getrandbits(8) for _ in range(2 ** 16))
+    _alphabet = string.ascii_letters + string.digits + '_-'
+
+    def _name():
+        return ''.join(_rng.choice(_alphabet) for _ in range(name_length))
+
+    _dirs = []
+    for _top in ('a', 'b'):
+        _level = [os.path.join(root, _top)]
+        for _ in range(depth):
+            _dirs.extend(_level)
+            _level = [os.path.join(d, _name())
+                      for d in _level for _ in range(fanout)]
+            if len(_dirs) + len(_level) > files:
+                break
+        _dirs.extend(_level)
+
+    _created = []
+    _bytes = 0
+    for i in range(files):
+        _path = os.path.join(_rng.choice(_dirs), _name())
+        if _created and _rng.random() < duplicates:
+            _size, _content_id = _rng.choice(_created)
+        else:
+            _size = _rng.choices([s for s, _ in sizes],
+                                 [w for _, w in sizes])[0]
+            _content_id = i
+        os.makedirs(os.path.dirname(_path), exist_ok=True)
+        with open(_path, 'wb') as _file:
+            # a unique header in front of the (shared) filler makes the
+            # content unique - and differ within the fingerprint samples
+            _header = b'%d\n' % _content_id
+            _file.write(_header[:_size])
+            _remaining = _size - len(_header)
+            _offset = _content_id % len(_filler)
+            while _remaining > 0:
+                _chunk = _filler[_offset:_offset + _remaining]
+                _file.write(_chunk)
+                _remaining -= len(_chunk)
+                _offset = 0
+        _created.append((_size, _content_id))
+        _bytes += _size
+    return files, _bytes
+
+
+def revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_index(tree_args, jobs=1, repeat=1):
+    ''' generates a tree and times the phases listed in the module doc on
+        it - returns a list of result dicts '''
+    _tmp_dir = tempfile.mkdtemp(prefix='fsi-bench-')
+    _root = os.path.join(_tmp_dir, 'tree')
+    _common = {
+        'benchmark': 'index',
+        'revision': revision(),
+        'python': platform.python_version(),
+        'jobs': jobs,
+    }
+    _common.update(tree_args)
+    _common['sizes'] = ','.join('%d:%d' % s for s in tree_args['sizes'])
+    _results = []
+
+    def _time(phase, function):
+        _best = None
+        for _ in range(repeat):
+            with open(os.devnull, 'w') as _null, \
+                    contextlib.redirect_stdout(_null):
+                _t = time.perf_counter()
+                function()
+                _t = time.perf_counter() - _t
+            _best = _t if _best is None else min(_best, _t)
+        _results.append(dict(_common, phase=phase, seconds=_best))
+
+    try:
+        _files, _bytes = generate_tree(_root, **tree_args)
+        _common.update(file_count=_files, byte_count=_bytes)
+        _a, _b = os.path.join(_root, 'a'), os.path.join(_root, 'b')
+        _storage = os.path.join(_tmp_dir, 'storage')
+
+        def _cold_add():
+            shutil.rmtree(_storage, ignore_errors=True)
+            with fsi.indexer(storage_dir=_storage, jobs=jobs) as _indexer:
+                _indexer.add(_root)
+
+        _time('add-cold', _cold_add)
+        with fsi.indexer(storage_dir=_storage, jobs=jobs) as _indexer:
+            _time('add-warm', lambda: _indexer.add(_root))
+            _time('diff', lambda: _indexer.diff(_a, _b))
+            _time('diff-from-index',
+                  lambda: _indexer.diff(_a, _b, from_index=True))
+            _time('check-redundancy',
+                  lambda: _indexer.check_redundancy(_a))
+            _time('check-redundancy-from-index',
+                  lambda: _indexer.check_redundancy(_a, from_index=True))
+    finally:
+        shutil.rmtree(_tmp_dir)
+    return _results
+
+
+STARTUP_COMMANDS = (
+    ('import', None),
+    ('info', ['info']),
+    ('check-dups-from-index', ['--from-index', 'check-dups', '{a}']),
+    ('diff-from-index', ['--from-index', 'diff', '{a}', '{b}']),
+    ('is-backed-up', ['is-backed-up', '{file}']),
+)
+
+
+def bench_startup(tree_args, repeat=10):
+    ''' runs each of STARTUP_COMMANDS <repeat> times in a new process on a
+        generated and indexed tree and returns the best wall clock times
+    '''
+    _script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'fsi.py')
+    _tmp_dir = tempfile.mkdtemp(prefix='fsi-bench-')
+    _root = os.path.join(_tmp_dir, 'tree')
+    _storage = os.path.join(_tmp_dir, 'storage')
+    _common = {
+        'benchmark': 'startup',
+        'revision': revision(),
+        'python': platform.python_version(),
+    }
+    _results = []
+    try:
+        _files, _ = generate_tree(_root, **tree_args)
+        _common.update(file_count=_files)
+        with fsi.indexer(storage_dir=_storage) as _indexer:
+            _indexer.add(_root)
+        _values = {
+            'a': os.path.join(_root, 'a'),
+            'b': os.path.join(_root, 'b'),
+            'file': next(os.path.join(d, f[0])
+                         for d, _, f in os.walk(_root) if f)}
+        for _name, _arguments in STARTUP_COMMANDS:
+            if _arguments is None:
+                _command = [sys.executable, '-c', 'import fsi']
+            else:
+                _command = [sys.executable, _script, '--storage-dir', _storage,
+                            '--no-daemon'] + [
+                                a.format(**_values) for a in _arguments]
+            _best = None
+            for _ in range(repeat):
+                _t = time.perf_counter()
+                subprocess.call(
+                    _command, cwd=os.path.dirname(_script),
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                _t = time.perf_counter() - _t
+                _best = _t if _best is None else min(_best, _t)
+            _results.append(dict(_common, command=_name, seconds=_best))
+    finally:
+        shutil.rmtree(_tmp_dir)
+    return _results
+
+
+def bench_hash(sizes, total_bytes, repeat, functions):
+    ''' hashes <total_bytes> split into files of each given size with every
+        hash function and returns a list of result dicts '''
+    _results = []
+    _tmp_dir = tempfile.mkdtemp(prefix='fsi-bench-')
+    try:
+        for _size in sizes:
+            _count = max(1, min(1000, total_bytes // _size))
+            _files = []
+            for i in range(_count):
+                _files.append(os.path.join(_tmp_dir, '%d-%d' % (_size, i)))
+                with open(_files[-1], 'wb') as _f:
+                    _f.write(os.urandom(_size))
+            _expected = {a: [fsi.hash_file(f, algorithm=a) for f in _files]
+                         for a in fsi.HASH_ALGORITHMS}
+
+            for _name in functions:
+                _function = HASH_FUNCTIONS[_name]
+                _best = None
+                for _ in range(repeat):
+                    _t = time.perf_counter()
+                    _hashes = [_function(f) for f in _files]
+                    _t = time.perf_counter() - _t
+                    _best = _t if _best is None else min(_best, _t)
+                assert _hashes == _expected[
+                    _name[4:] if _name.startswith('fsi-') else 'sha1'], _name
+                _results.append({
+                    'benchmark': 'hash',
+                    'function': _name,
+                    'file_size': _size,
+                    'file_count': _count,
+                    'seconds': _best,
+                    'mb_per_s': _size * _count / _best / 2 ** 20,
+                })
+
+            for f in _files:
+                os.remove(f)
+    finally:
+        shutil.rmtree(_tmp_dir)
+    return _results
+
+
+def print_results(results, as_json):
+    if as_json:
+        for r in results:
+            print(json.dumps(r, sort_keys=True))
+        return
+    for r in results:
+        if r['benchmark'] == 'startup':
+            print('%-28s %8d files: %10.1fms' % (
+                r['command'], r['file_count'], r['seconds'] * 1000))
+            continue
+        if r['benchmark'] == 'index':
+            print('%-28s %8d files %14s bytes: %10.1fms' % (
+                r['phase'], r['file_count'], '{0:,}'.format(r['byte_count']),
+                r['seconds'] * 1000))
+            continue
+        print('%-16s %12s bytes x %4d: %8.1fms  %8.1fMB/s' % (
+            r['function'], '{0:,}'.format(r['file_size']), r['file_count'],
+            r['seconds'] * 1000, r['mb_per_s']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='fs_inspect benchmarks')
+    parser.add_argument('--json', action='store_true',
+                        help='print one JSON object per result')
+    subparsers = parser.add_subparsers(dest='BENCHMARK')
+
+    hash_parser = subparsers.add_parser('hash')
+    hash_parser.add_argument('--sizes', default='4K,64K,1M,16M,128M')
+    hash_parser.add_argument('--total', default='256M',
+                             help='bytes to hash per file size')
+    hash_parser.add_argument('--repeat', type=int, default=3)
+    hash_parser.add_argument(
+        '--functions', default=','.join(
+            f for f in sorted(HASH_FUNCTIONS)
+            if f not in ('legacy-external', 'legacy-split') or
+            shutil.which('sha1sum')))
+
+    index_parser = subparsers.add_parser('index')
+    index_parser.add_argument('--files', type=int, default=10000)
+    index_parser.add_argument('--sizes', default='1K:60,64K:30,4M:10',
+                              help='file sizes with relative weights')
+    index_parser.add_argument('--duplicates', type=float, default=0.2,
+                              help='fraction of files being copies')
+    index_parser.add_argument('--depth', type=int, default=4)
+    index_parser.add_argument('--fanout', type=int, default=4)
+    index_parser.add_argument('--name-length', type=int, default=12)
+    index_parser.add_argument('--seed', type=int, default=0)
+    index_parser.add_argument('--jobs', '-j', type=int, default=1)
+    index_parser.add_argument('--repeat', type=int, default=1)
+
+    startup_parser = subparsers.add_parser('startup')
+    startup_parser.add_argument('--files', type=int, default=10000)
+    startup_parser.add_argument('--seed', type=int, default=0)
+    startup_parser.add_argument('--repeat', type=int, default=10)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    if args.BENCHMARK == 'hash':
+        print_results(
+            bench_hash([parse_size(s) for s in args.sizes.split(',')],
+                       parse_size(args.total), args.repeat,
+                       args.functions.split(',')),
+            args.json)
+    elif args.BENCHMARK == 'index':
+        print_results(
+            bench_index({
+                'files': args.files,
+                'sizes': parse_distribution(args.sizes),
+                'duplicates': args.duplicates,
+                'depth': args.depth,
+                'fanout': args.fanout,
+                'name_length': args.name_length,
+                'seed': args.seed,
+            }, jobs=args.jobs, repeat=args.repeat),
+            args.json)
+    elif args.BENCHMARK == 'startup':
+        print_results(
+            bench_startup({
+                'files': args.files,
+                'sizes': [(64, 1)],
+                'seed': args.seed,
+            }, repeat=args.repeat),
+            args.json)
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,18 +3,42 @@
 
 import os
 import sys
+import stat
 import logging
 import time
 import json
 import hashlib
-import functools
-import subprocess
 import contextlib
-import shutil
-import argparse
+import sqlite3
+import collections
+import threading
+import functools
+import io
+# argparse, shutil, concurrent.futures, socket, select, struct and ctypes
+# are imported where needed - importing them costs noticeable start up
+# time for commands which don't use them
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 DEBUG_MODE = False
 
+# files of at least this size get compared by a fingerprint of some samples
+# of their content before a full hash is computed
+PREFILTER_MIN_SIZE = 2 ** 16
+PREFILTER_SAMPLE_SIZE = 2 ** 12
+
+# content hash algorithms an index can be built with
+HASH_ALGORITHMS = {
+    'sha1': hashlib.sha1,
+    'blake2b': functools.partial(hashlib.blake2b, digest_size=32),
+}
+if xxhash is not None:
+    # not cryptographic but much faster
+    HASH_ALGORITHMS['xxh128'] = xxhash.xxh3_128
+
 class fsi_error(Exception):
     def __init__(self):
         Exception.__init__(self)
@@ -29,9 +53,37 @@ class read_permission_error(fsi_error):
     pass
 
 class not_indexed_error(fsi_error):
-    def __init__(self, file_instance=None):
+    def __init__(self, file_instance=None, path=None):
         fsi_error.__init__(self)
         self.file_info = file_instance
+        self._path = path
+
+    def path(self):
+        ''' returns the file or directory which is not (up to date) in the
+            index - None if unknown '''
+        if self.file_info is not None:
+            return self.file_info.path()
+        return self._path
+
+class index_format_error(fsi_error):
+    def __init__(self, message):
+        fsi_error.__init__(self)
+        self.message = message
+
+class index_busy_error(fsi_error):
+    def __init__(self, message):
+        fsi_error.__init__(self)
+        self.message = message
+
+class watch_error(fsi_error):
+    def __init__(self, message):
+        fsi_error.__init__(self)
+        self.message = message
+
+class daemon_error(fsi_error):
+    def __init__(self, message):
+        fsi_error.__init__(self)
+        self.message = message
 
 def fopen(filename, mode='r', buffering=1):
     try:
@@ -45,6 +97,7 @@ def fopen(filename, mode='r', buffering=1):
 
 def rmdirs(path):
     try:
+        import shutil
         shutil.rmtree(path)
     except OSError as ex:
         if ex.errno == 2:
@@ -66,59 +119,315 @@ def make_dirs(path):
             raise path_exists_error()
         raise
 
-def load_json(filename):
-    return json.load(fopen(filename), encoding='utf-8')
-
 if sys.version_info[0] >= 3:
 
+    def load_json(filename):
+        return json.load(fopen(filename))
+
     def dump_json(data, filename):
         json.dump(data, fopen(filename, 'w'),
                   sort_keys=True,
                   indent=4, separators=(',', ': '))
 
-    def path_join(path1, path2):
-        return os.path.join(path1, path2)
-
 else:
+    def load_json(filename):
+        return json.load(fopen(filename), encoding='utf-8')
+
     def dump_json(data, filename):
         json.dump(data, fopen(filename, 'w'), encoding='utf-8',
                   sort_keys=True,
                   indent=4, separators=(',', ': '))
 
-    def path_join(path1, path2):
-        return os.path.join(path1, path2).decode('utf-8')
 
+def hash_chunk_size(size):
+    ''' returns the number of bytes to read at once when hashing a file of
+        a given size - larger files get read in larger chunks '''
+    if size < 2 ** 20:
+        return 2 ** 16
+    if size < 2 ** 26:
+        return 2 ** 18
+    return 2 ** 20
+
+
+# one read buffer per hashing thread which gets reused for every file
+_read_buffers = threading.local()
+
+
+def hash_file(filename, size=None, algorithm='sha1'):
+    ''' hashes a file in-process. The content gets read into a preallocated
+        buffer (no new bytes object per chunk, no copy for hashlib) using
+        unbuffered I/O, so large files are as fast as with `sha1sum`
+    '''
+    _hash = HASH_ALGORITHMS[algorithm]()
+    with wopen(filename, 'rb', 0) as _file:
+        if size is None:
+            size = os.fstat(_file.fileno()).st_size
+        _chunk_size = hash_chunk_size(size)
+        if size <= _chunk_size:
+            # one read is enough - no need for the shared buffer
+            _hash.update(_file.read())
+            return _hash.hexdigest()
+        _buffer = getattr(_read_buffers, 'buffer', None)
+        if _buffer is None or len(_buffer) < _chunk_size:
+            _buffer = _read_buffers.buffer = bytearray(_chunk_size)
+        _view = memoryview(_buffer)[:_chunk_size]
+        while True:
+            _count = _file.readinto(_view)
+            if not _count:
+                break
+            _hash.update(_view[:_count])
+    return _hash.hexdigest()
+
+
+def sample_fingerprint(filename, size, algorithm='sha1',
+                       sample_size=PREFILTER_SAMPLE_SIZE):
+    ''' cheap hash over the first, the middle and the last <sample_size>
+        bytes of a file - files with different fingerprints can't be equal
+    '''
+    _hash = HASH_ALGORITHMS[algorithm]()
+    with wopen(filename, 'rb', 0) as _file:
+        for _offset in (0, (size - sample_size) // 2, size - sample_size):
+            _file.seek(_offset)
+            _hash.update(_file.read(sample_size))
+    return _hash.hexdigest()
+
+
+class run_stats:
+    ''' time spent per phase and counters of one run (see `--stats`).
+        Threads (hash jobs, walkers) may report concurrently - their times
+        add up, so phases can sum up to more than the wall time
+    '''
 
-def sha1_external(filename):
-    ''' fast with large files '''
-    output = subprocess.Popen(
-        ["sha1sum", filename.encode('utf-8')],
-        stdout=subprocess.PIPE).communicate()[0].decode('utf-8')
-    # todo: check plausibility (length, "permission denied", etc)
-    return output.split(' ')[0]
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seconds = collections.Counter()
+        self._counts = collections.Counter()
 
+    @contextlib.contextmanager
+    def timed(self, phase):
+        _start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(phase, time.perf_counter() - _start)
+
+    def add_time(self, phase, seconds, counter=None, value=1):
+        ''' accounts <seconds> to <phase> and increments <counter> if given
+            (which saves a second lock acquisition in hot paths) '''
+        with self._lock:
+            self._seconds[phase] += seconds
+            if counter is not None:
+                self._counts[counter] += value
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counts[name] += value
+
+    def as_dict(self):
+        with self._lock:
+            return {'seconds': dict(self._seconds),
+                    'counts': dict(self._counts)}
+
+
+class inotify_watcher:
+    ''' minimal binding of Linux' inotify via ctypes: watches directories
+        (not recursively) and returns the events for files and directories
+        inside of them '''
+
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = 0o2000000
+
+    MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+            IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR)
 
-def sha1_internal(filename, chunksize=2**15, bufsize=-1):
-    ''' fast with small files '''
-    # max-limit-of-bytes-in-method-update-of-hashlib-python-module
-    # http://stackoverflow.com/questions/4949162
-    sha1_hash = hashlib.sha1()
-    with wopen(filename, 'rb', bufsize) as _file:
-        for chunk in iter(functools.partial(_file.read, chunksize), b''):
-            sha1_hash.update(chunk)
-    return sha1_hash.hexdigest()
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise watch_error('inotify is only available on Linux')
+        import ctypes
+        import ctypes.util
+        import select
+        import struct
+        self._ctypes = ctypes
+        self._select = select.select
+        self._event = struct.Struct('iIII')
+        self._libc = ctypes.CDLL(
+            ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self._fd < 0:
+            raise watch_error(
+                'inotify_init1: %s' % os.strerror(ctypes.get_errno()))
+        self._paths = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, data_type, value, tb):
+        self.close()
+
+    def __len__(self):
+        return len(self._paths)
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def add_watch(self, directory):
+        ''' returns False if <directory> can't be watched (e.g. because it
+            has vanished or the number of watches is exhausted) '''
+        _wd = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(directory), self.MASK)
+        if _wd < 0:
+            logging.warning('cannot watch "%s": %s', directory,
+                            os.strerror(self._ctypes.get_errno()))
+            return False
+        self._paths[_wd] = directory
+        return True
+
+    def read_events(self, timeout=None):
+        ''' waits up to <timeout> seconds for events and returns them as a
+            list of (path, mask) tuples - path is None for IN_Q_OVERFLOW '''
+        if not self._select([self._fd], [], [], timeout)[0]:
+            return []
+        try:
+            _buffer = os.read(self._fd, 2 ** 16)
+        except BlockingIOError:
+            return []
+        _events = []
+        _offset = 0
+        while _offset < len(_buffer):
+            _wd, _mask, _, _length = self._event.unpack_from(_buffer, _offset)
+            _offset += self._event.size
+            _name = os.fsdecode(
+                _buffer[_offset:_offset + _length].rstrip(b'\0'))
+            _offset += _length
+            if _mask & self.IN_Q_OVERFLOW:
+                _events.append((None, _mask))
+                continue
+            _directory = self._paths.get(_wd)
+            if _mask & self.IN_IGNORED:
+                self._paths.pop(_wd, None)
+            if _directory is None or not _name:
+                continue
+            _events.append((os.path.join(_directory, _name), _mask))
+        return _events
+
+
+def walk_position(path):
+    ''' returns a sort key for a file <path> relative to a walked directory
+        which reflects the order `indexer._walk` visits files in: files of
+        a directory come first, then its subdirectories, both sorted by name
+    '''
+    _components = path.split('/')
+    return (tuple((1, c) for c in _components[:-1]) +
+            ((0, _components[-1]),))
+
+
+class progress_reporter:
+    ''' prints the progress of `indexer.add` at most every <interval>
+        seconds: processed files and bytes, the current hashing and file
+        rate and - if the number of files to expect is known from an
+        earlier run or from counting them (see expect_files()) - an ETA.
+        Writes JSON lines if <stream> is not a
+        terminal (unless <as_json> says otherwise)
+    '''
+
+    def __init__(self, stream=None, interval=1.0, as_json=None):
+        self._stream = sys.stderr if stream is None else stream
+        self._interval = interval
+        self._as_json = (not self._stream.isatty() if as_json is None
+                         else as_json)
+        self._stats = None
+
+    def start(self, expected_files=None, expected_bytes=None, stats=None):
+        self._expected = (expected_files or None, expected_bytes or None)
+        self._stats = stats
+        self._start = self._last = time.monotonic()
+        self._last_files = 0
+        self._last_hashed = self._hashed()
+
+    def expect_files(self, count):
+        ''' sets the number of files to expect once it is known - might be
+            called from another thread '''
+        self._expected = (count or None, self._expected[1])
+
+    def _hashed(self):
+        return (0 if self._stats is None else
+                self._stats.as_dict()['counts'].get('bytes_hashed', 0))
+
+    def update(self, files, size):
+        ''' cheap enough to be called for every file '''
+        if time.monotonic() - self._last >= self._interval:
+            self._report(files, size)
+
+    def finish(self, files, size):
+        self._report(files, size, final=True)
+
+    def _report(self, files, size, final=False):
+        _now = time.monotonic()
+        _elapsed = max(_now - self._last, 1e-9)
+        _hashed = self._hashed()
+        _state = {
+            'files': files,
+            'bytes': size,
+            'elapsed_s': round(_now - self._start, 3),
+            'files_per_s': round((files - self._last_files) / _elapsed, 1),
+            'hash_mb_per_s': round(
+                (_hashed - self._last_hashed) / _elapsed / 2 ** 20, 2),
+            'eta_s': None,
+        }
+        self._last, self._last_files, self._last_hashed = (
+            _now, files, _hashed)
+
+        if final:
+            _state['eta_s'] = 0
+        elif self._expected[1] and 0 < size < self._expected[1]:
+            _state['eta_s'] = round(
+                (_now - self._start) * (self._expected[1] - size) / size, 1)
+        elif self._expected[0] and 0 < files < self._expected[0]:
+            _state['eta_s'] = round(
+                (_now - self._start) * (self._expected[0] - files) / files, 1)
+
+        if self._as_json:
+            self._stream.write(json.dumps(_state, sort_keys=True) + '\n')
+        else:
+            self._stream.write(
+                '\r%s files  %s MB  %6.1f MB/s hashed  %7.1f files/s  '
+                'ETA %s ' % (
+                    '{0:,}'.format(files), '{0:,}'.format(size // 2 ** 20),
+                    _state['hash_mb_per_s'], _state['files_per_s'],
+                    '--:--:--' if _state['eta_s'] is None else
+                    time.strftime('%H:%M:%S', time.gmtime(_state['eta_s']))))
+            if final:
+                self._stream.write('\n')
+        self._stream.flush()
 
 
 class file_info:
 
-    def __init__(self, filename, word_store=None):
+    def __init__(self, filename, directories=None, hasher=None,
+                 stat_result=None):
         assert filename[0] == '/'
         self._fullname = filename
+        self._stat = stat_result
         self._size = None
-        self._packed_path = None
-        self._sha1 = None
+        self._key = None
+        self._hash = None
+        self._fingerprint = None
         self._mdate = None
-        self._word_store = word_store
+        self._directories = directories
+        self._hasher = hasher
 
     def __str__(self):
         return self._fullname
@@ -129,57 +438,1078 @@ class file_info:
     def basename(self):
         return os.path.basename(self._fullname)
 
+    def stat(self):
+        ''' returns the (cached) result of lstat() - symlinks are never
+            followed '''
+        if self._stat is None:
+            try:
+                self._stat = os.lstat(self._fullname)
+            except OSError as ex:
+                if ex.errno == 2:
+                    raise file_not_found_error()
+                elif ex.errno == 13:
+                    raise read_permission_error()
+                raise
+        return self._stat
+
     def size(self):
         if self._size is None:
-            self._size = os.path.getsize(self._fullname)
+            self._size = self.stat().st_size
         return self._size
 
     def mdate(self):
         if self._mdate is None:
-            self._mdate = str(int(os.path.getmtime(self._fullname) * 100))
+            self._mdate = str(int(self.stat().st_mtime * 100))
         return self._mdate
 
-    @staticmethod
-    def fast_sha1(filename, size):
-        if size < 50000:
-            return sha1_internal(filename)
+    def signature(self):
+        ''' returns a tuple of stat values which change whenever the file
+            gets modified '''
+        _stat = self.stat()
+        return (_stat.st_size, _stat.st_mtime_ns,
+                _stat.st_ino, _stat.st_dev, _stat.st_ctime_ns)
+
+    def inode_signature(self):
+        ''' returns (size, mtime_ns, inode, device) - which is the same for
+            all hardlinks of an unchanged file - or None if the file has
+            no other links. The ctime is left out on purpose: creating a
+            link changes it '''
+        _stat = self.stat()
+        if _stat.st_nlink < 2:
+            return None
+        return (_stat.st_size, _stat.st_mtime_ns, _stat.st_ino, _stat.st_dev)
+
+    def hash_algorithm(self):
+        return 'sha1' if self._hasher is None else self._hasher.algorithm()
+
+    def content_hash(self):
+        if self._hash is None:
+            if self._hasher is None:
+                self._hash = hash_file(self._fullname, self.size())
+            else:
+                self._hash = self._hasher.hash(
+                    self._fullname, self.size(), self.inode_signature())
+        return self._hash
+
+    def fingerprint(self):
+        ''' returns a fingerprint of the file's content or None for files
+            too small to be worth it '''
+        if self._fingerprint is None and self.size() >= PREFILTER_MIN_SIZE:
+            self._fingerprint = (
+                sample_fingerprint(self._fullname, self.size())
+                if self._hasher is None else
+                self._hasher.fingerprint(self._fullname, self.size()))
+        return self._fingerprint
+
+    def is_normal_file(self):
+        try:
+            return stat.S_ISREG(self.stat().st_mode)
+        except fsi_error:
+            return False
+
+    def key(self):
+        ''' returns the file's key in the index: a tuple (node id of its
+            directory, index of its name) '''
+        if self._key is None:
+            assert self._directories is not None
+            self._key = self._directories.key(self._fullname)
+        return self._key
+
+
+class hash_engine:
+    ''' computes file hashes for the indexer. With <jobs> > 1 hashes can be
+        requested in advance via prefetch() and get computed on a thread pool
+        (hashlib releases the GIL while hashing larger chunks).
+        Hashes of hardlinked files are remembered by their inode signature
+        (see file_info.inode_signature()) so every inode gets read once.
+        Every device gets its own pool of <jobs> threads so one slow disk
+        doesn't hold up reading the others
+    '''
+
+    def __init__(self, jobs=1, algorithm='sha1', stats=None):
+        self._jobs = jobs
+        self._algorithm = algorithm
+        self._stats = stats if stats is not None else run_stats()
+        self._pools = {}
+        self._pending = {}
+        self._inodes = {}
+
+    def jobs(self):
+        return self._jobs
+
+    def algorithm(self):
+        return self._algorithm
+
+    def prefetch(self, filename, inode_signature=None):
+        ''' start computing the hash of <filename> in the background '''
+        if (self._jobs < 2 or filename in self._pending or
+                inode_signature in self._inodes):
+            return
+        try:
+            _device = (os.stat(filename).st_dev if inode_signature is None
+                       else inode_signature[3])
+        except OSError:
+            # will be reported when the hash is needed
+            return
+        _pool = self._pools.get(_device)
+        if _pool is None:
+            import concurrent.futures
+            _pool = self._pools[_device] = (
+                concurrent.futures.ThreadPoolExecutor(max_workers=self._jobs))
+        self._pending[filename] = _pool.submit(
+            self._hash_file, filename, None)
+        if inode_signature is not None:
+            self._inodes[inode_signature] = self._pending[filename]
+
+    def _hash_file(self, filename, size):
+        if size is None:
+            size = os.stat(filename).st_size
+        _start = time.perf_counter()
+        _hash = hash_file(filename, size, self._algorithm)
+        self._stats.add_time('hash', time.perf_counter() - _start, 'hashes')
+        self._stats.count('bytes_hashed', size)
+        return _hash
+
+    def hash(self, filename, size, inode_signature=None):
+        ''' returns the hash of <filename> - waits for a prefetched result
+            if available and computes it synchronously otherwise '''
+        _future = self._pending.pop(filename, None)
+        if _future is None and inode_signature is not None:
+            _known = self._inodes.get(inode_signature)
+            if isinstance(_known, str):
+                self._stats.count('hashes_reused')
+                return _known
+            if _known is not None and not _known.cancelled():
+                self._stats.count('hashes_reused')
+                _future = _known
+        if _future is not None:
+            with self._stats.timed('hash_wait'):
+                _hash = _future.result()
         else:
-            return sha1_external(filename)
+            _hash = self._hash_file(filename, size)
+        if inode_signature is not None:
+            self._inodes[inode_signature] = _hash
+        return _hash
+
+    def fingerprint(self, filename, size):
+        _start = time.perf_counter()
+        _fingerprint = sample_fingerprint(filename, size, self._algorithm)
+        self._stats.add_time('fingerprint', time.perf_counter() - _start,
+                             'fingerprints')
+        self._stats.count('bytes_sampled', 3 * PREFILTER_SAMPLE_SIZE)
+        return _fingerprint
+
+    def clear(self):
+        for _future in self._pending.values():
+            _future.cancel()
+        self._pending = {}
+        self._inodes = {}
+
+    def close(self):
+        self.clear()
+        for _pool in self._pools.values():
+            _pool.shutdown()
+
+
+class index_backend:
+    ''' interface for the storage behind `indexer`. For every file size the
+        index knows either nothing, exactly one file (in which case no hash
+        is needed) or a number of files together with their fingerprints
+        and/or hashes ("multi").
+        Files are identified by a key (directory node id, name index) - see
+        `indexer.directory_table`.
+        Derived classes only have to provide these primitives - all
+        decisions about when to hash what are taken by `indexer`.
+    '''
+
+    def size_state(self, size):
+        ''' returns None if <size> is not registered yet, ('single', key)
+            if there is exactly one file without hash or ('multi', None)
+        '''
+        raise NotImplementedError()
+
+    def store_single(self, size, key, signature=None):
+        ''' register the only file with a given size '''
+        raise NotImplementedError()
+
+    def store_reference(self, size, hash_value, key, mdate,
+                        fingerprint=None, signature=None):
+        ''' register a file with its hash and/or fingerprint - turns a single
+            entry into a multi entry if needed. <signature> is a tuple
+            (size, mtime_ns, inode, device, ctime_ns) '''
+        raise NotImplementedError()
+
+    def set_hash(self, size, key, hash_value):
+        ''' add the hash to an already registered file '''
+        raise NotImplementedError()
+
+    def remove_references(self, keys):
+        ''' removes the files with given keys from the index '''
+        raise NotImplementedError()
+
+    def entries_after(self, key, count):
+        ''' returns up to <count> (key, size, mtime_ns) tuples of the files
+            following <key> (None: the first ones) in key order '''
+        raise NotImplementedError()
+
+    def collapse_sizes(self, sizes):
+        ''' turns the entries of all given sizes which have only one file
+            left into single entries - returns their number '''
+        raise NotImplementedError()
+
+    def used_directories(self):
+        ''' returns the set of directory nodes containing files '''
+        raise NotImplementedError()
+
+    def remove_nodes(self, nodes):
+        ''' removes the given directory nodes '''
+        raise NotImplementedError()
+
+    def store_references(self, rows):
+        ''' store_reference() for many (size, hash, key, mdate, fingerprint,
+            signature) tuples '''
+        for _row in rows:
+            self.store_reference(*_row)
+
+    def set_hashes(self, rows):
+        ''' set_hash() for many (size, key, hash) tuples '''
+        for _row in rows:
+            self.set_hash(*_row)
+
+    def entry(self, size, key):
+        ''' returns a tuple (hash, fingerprint, mdate) for a registered file
+            or None if not registered '''
+        raise NotImplementedError()
+
+    def references(self, size, hash_value):
+        ''' returns a dict {key: mdate} of files with given hash '''
+        raise NotImplementedError()
+
+    def fingerprint_peers(self, size, fingerprint):
+        ''' returns a dict {key: (hash, mdate)} of files with given
+            size and fingerprint - including files of that size which
+            have been registered without fingerprint (e.g. by older index
+            versions) since they might have the same content '''
+        raise NotImplementedError()
+
+    def inode_peers(self, inode_signature):
+        ''' returns a dict {key: (hash, fingerprint)} of files stored with
+            the given (size, mtime_ns, inode, device) - i.e. hardlinks of
+            the same unchanged file '''
+        raise NotImplementedError()
+
+    def signatures(self, pre, post):
+        ''' returns a dict {key: signature} for all files in directories
+            numbered <pre> to <post> (i.e. below a given directory) '''
+        raise NotImplementedError()
+
+    def files_below(self, pre, post):
+        ''' yields (key, size, hash, fingerprint, mtime_ns) for all files in
+            directories numbered <pre> to <post> '''
+        raise NotImplementedError()
+
+    def copies_outside(self, pre, post):
+        ''' yields (key, other key, other mtime_ns, same inode) for all files
+            in directories numbered <pre> to <post> which have a copy outside
+            of this range - <same inode> is True for hardlinks '''
+        raise NotImplementedError()
+
+    def nodes(self):
+        ''' returns all directory nodes as (id, parent, name, pre, post)
+            tuples '''
+        raise NotImplementedError()
+
+    def stale_nodes(self):
+        ''' returns the ids of all directory nodes whose files have been
+            added, removed or have got another hash since their digests have
+            been stored '''
+        raise NotImplementedError()
+
+    def files_in(self, node):
+        ''' returns (name, size, hash, fingerprint) for all files located
+            directly in directory <node> '''
+        raise NotImplementedError()
+
+    def subdirectories(self, node):
+        ''' returns (id, name, digest, unnamed digest) for all directory
+            nodes directly below <node> '''
+        raise NotImplementedError()
+
+    def store_digests(self, rows):
+        ''' stores (digest, unnamed digest, node) tuples - the nodes aren't
+            stale anymore afterwards '''
+        raise NotImplementedError()
+
+    def duplicate_nodes(self, ignore_names=False):
+        ''' returns a dict {digest: [node, ..]} of all digests (or unnamed
+            digests) shared by more than one node '''
+        raise NotImplementedError()
+
+    def equal_nodes(self, pre, post, other_pre, other_post):
+        ''' returns the set of nodes numbered <pre> to <post> which have the
+            same unnamed digest as a node numbered <other_pre> to
+            <other_post> - nodes without indexed files don't count '''
+        raise NotImplementedError()
+
+    def store_node(self, node, parent, name):
+        raise NotImplementedError()
+
+    def store_numbering(self, numbers):
+        ''' stores new pre/post order numbers given as (pre, post, node)
+            tuples '''
+        raise NotImplementedError()
+
+    def get_meta(self, key):
+        ''' returns a stored property of the index or None '''
+        raise NotImplementedError()
+
+    def set_meta(self, key, value):
+        ''' stores a property of the index - None removes it '''
+        raise NotImplementedError()
+
+    def is_empty(self):
+        raise NotImplementedError()
+
+    def all_entries(self):
+        ''' returns (key, size, hash) for every registered file - for tests
+            and debugging '''
+        raise NotImplementedError()
+
+    def check(self):
+        ''' returns a list of problems found in the stored data '''
+        return []
+
+    def storage_size(self):
+        ''' returns the number of bytes the index occupies or None '''
+        return None
+
+    def compact(self):
+        ''' gives space of removed entries back to the file system '''
+        pass
+
+    def data_version(self):
+        ''' returns a value which changes whenever another process has
+            committed changes - or None if that can't be detected '''
+        return None
+
+    def remove_names_from(self, count):
+        ''' removes all directories and files using name indices >= <count>
+            (and everything below them) - returns the number of removed
+            files '''
+        raise NotImplementedError()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        ''' discards all changes since the last commit '''
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+def _sqlite_use_directory_nodes(db):
+    ''' schema upgrade: files reference a directory node and a name index
+        instead of storing their packed path (e.g. "2.7.4.9") '''
+    db.execute('''
+        CREATE TABLE nodes (
+            id INTEGER PRIMARY KEY,
+            parent INTEGER,
+            name INTEGER,
+            pre INTEGER,
+            post INTEGER)''')
+    db.execute('CREATE INDEX nodes_pre ON nodes (pre)')
+    db.execute('''
+        CREATE TABLE files_by_node (
+            dir INTEGER NOT NULL,
+            name INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            hash TEXT,
+            mdate TEXT,
+            fingerprint TEXT,
+            mtime_ns INTEGER,
+            inode INTEGER,
+            device INTEGER,
+            ctime_ns INTEGER,
+            PRIMARY KEY (dir, name))''')
+
+    _nodes = {}
+
+    def node(components):
+        if components not in _nodes:
+            _nodes[components] = len(_nodes)
+            db.execute(
+                'INSERT INTO nodes (id, parent, name) VALUES (?, ?, ?)',
+                (_nodes[components],
+                 node(components[:-1]) if components else None,
+                 components[-1] if components else None))
+        return _nodes[components]
+
+    node(())
+    for _row in db.execute('SELECT path, size, hash, mdate, fingerprint, '
+                           'mtime_ns, inode, device, ctime_ns '
+                           'FROM files').fetchall():
+        _components = tuple(int(c) for c in _row[0].split('.'))
+        db.execute(
+            'INSERT INTO files_by_node VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (node(_components[:-1]), _components[-1]) + _row[1:])
+
+    db.execute('DROP TABLE files')
+    db.execute('ALTER TABLE files_by_node RENAME TO files')
+    db.execute('CREATE INDEX files_size ON files (size)')
+    db.execute('CREATE INDEX files_hash ON files (hash)')
+    db.execute('CREATE INDEX files_fingerprint ON files (size, fingerprint)')
+
+
+def _sqlite_add_directory_digests(db):
+    ''' schema upgrade: directory nodes get digests of their content, nodes
+        with changed files get tracked by triggers '''
+    db.execute('ALTER TABLE nodes ADD COLUMN digest TEXT')
+    db.execute('ALTER TABLE nodes ADD COLUMN unnamed_digest TEXT')
+    db.execute('CREATE INDEX nodes_parent ON nodes (parent)')
+    db.execute('CREATE INDEX nodes_digest ON nodes (digest)')
+    db.execute('CREATE INDEX nodes_unnamed_digest ON nodes (unnamed_digest)')
+    db.execute('CREATE TABLE stale_nodes (id INTEGER PRIMARY KEY)')
+    # no INSERT OR IGNORE in the triggers: the conflict clause would be
+    # replaced by the one of the statement firing them
+    db.execute('INSERT INTO stale_nodes SELECT DISTINCT dir FROM files')
+    db.execute('''
+        CREATE TRIGGER files_inserted AFTER INSERT ON files BEGIN
+            INSERT INTO stale_nodes SELECT NEW.dir WHERE NOT EXISTS (
+                SELECT 1 FROM stale_nodes WHERE id = NEW.dir);
+        END''')
+    db.execute('''
+        CREATE TRIGGER files_changed
+        AFTER UPDATE OF size, hash, fingerprint ON files
+        WHEN OLD.size IS NOT NEW.size OR OLD.hash IS NOT NEW.hash
+            OR OLD.fingerprint IS NOT NEW.fingerprint BEGIN
+            INSERT INTO stale_nodes SELECT NEW.dir WHERE NOT EXISTS (
+                SELECT 1 FROM stale_nodes WHERE id = NEW.dir);
+        END''')
+    db.execute('''
+        CREATE TRIGGER files_deleted AFTER DELETE ON files BEGIN
+            INSERT INTO stale_nodes SELECT OLD.dir WHERE NOT EXISTS (
+                SELECT 1 FROM stale_nodes WHERE id = OLD.dir);
+        END''')
 
-    def hash_sha1(self):
-        if self._sha1 is None:
-            self._sha1 = file_info.fast_sha1(self._fullname, self.size())
-        return self._sha1
 
-    def hash_file_path(self, size_path):
-        return os.path.join(size_path, self.hash_sha1())
+@contextlib.contextmanager
+def _translate_busy_error():
+    ''' turns SQLite errors caused by another process holding a lock on the
+        index into index_busy_error '''
+    try:
+        yield
+    except sqlite3.OperationalError as ex:
+        if not _is_busy_error(ex):
+            raise
+        raise index_busy_error(
+            'the index is in use by another process (%s)' % ex) from ex
+
+
+def _is_busy_error(ex):
+    return 'locked' in str(ex) or 'busy' in str(ex)
+
+
+class sqlite_backend(index_backend):
+    ''' stores the whole index in one SQLite database file '''
+
+    filename = 'index.sqlite'
+    schema_version = 5
+
+    # statements turning an index with schema version <n - 1> into <n>
+    schema_upgrades = {
+        2: ('ALTER TABLE files ADD COLUMN fingerprint TEXT',
+            'CREATE INDEX files_fingerprint ON files (size, fingerprint)'),
+        3: ('ALTER TABLE files ADD COLUMN mtime_ns INTEGER',
+            'ALTER TABLE files ADD COLUMN inode INTEGER',
+            'ALTER TABLE files ADD COLUMN device INTEGER',
+            'ALTER TABLE files ADD COLUMN ctime_ns INTEGER'),
+        4: (_sqlite_use_directory_nodes,),
+        5: (_sqlite_add_directory_digests,),
+    }
+
+    # seconds to wait for another process writing to the index
+    busy_timeout = 5.0
+
+    def __init__(self, storage_dir):
+        self._db = sqlite3.connect(os.path.join(storage_dir, self.filename),
+                                   timeout=self.busy_timeout)
+        with _translate_busy_error():
+            self._upgrade_schema()
+
+    def _upgrade_schema(self):
+        # only write if there is something to create or upgrade - opening
+        # an index for reading must not wait for a running `fsi add`
+        _version = None
+        if self._db.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND "
+                "name = 'meta'").fetchone() is not None:
+            _version = self._db.execute(
+                "SELECT value FROM meta WHERE key = 'schema_version'"
+            ).fetchone()
+        if _version is None:
+            self._db.executescript('''
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT);
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    hash TEXT,
+                    mdate TEXT);
+                CREATE INDEX IF NOT EXISTS files_size ON files (size);
+                CREATE INDEX IF NOT EXISTS files_hash ON files (hash);
+                INSERT OR IGNORE INTO meta VALUES ('schema_version', '1');
+            ''')
+            _version = ('1',)
+        _version = int(_version[0])
+        if _version == self.schema_version:
+            return
+        if _version > self.schema_version:
+            raise index_format_error(
+                'unsupported index schema version %d' % _version)
+        for v in range(_version + 1, self.schema_version + 1):
+            logging.debug('upgrade index schema to version %d', v)
+            for step in self.schema_upgrades[v]:
+                if callable(step):
+                    step(self._db)
+                else:
+                    self._db.execute(step)
+            self._db.execute(
+                "UPDATE meta SET value = ? WHERE key = 'schema_version'",
+                (str(v),))
+        self._db.commit()
+
+    def size_state(self, size):
+        _rows = self._db.execute(
+            'SELECT dir, name, hash, fingerprint FROM files '
+            'WHERE size = ? LIMIT 2', (size,)).fetchall()
+        if len(_rows) == 0:
+            return None
+        if len(_rows) == 1 and _rows[0][2] is None and _rows[0][3] is None:
+            return ('single', _rows[0][:2])
+        return ('multi', None)
+
+    def store_single(self, size, key, signature=None):
+        self.store_reference(size, None, key, None, signature=signature)
+
+    def store_reference(self, size, hash_value, key, mdate,
+                        fingerprint=None, signature=None):
+        self.store_references(
+            ((size, hash_value, key, mdate, fingerprint, signature),))
+
+    def store_references(self, rows):
+        # an update (instead of INSERT OR REPLACE) lets the files_changed
+        # trigger tell whether the content has changed
+        self._db.executemany(
+            'INSERT INTO files (dir, name, size, hash, mdate, '
+            'fingerprint, mtime_ns, inode, device, ctime_ns) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (dir, name) DO UPDATE SET size = excluded.size, '
+            'hash = excluded.hash, mdate = excluded.mdate, '
+            'fingerprint = excluded.fingerprint, '
+            'mtime_ns = excluded.mtime_ns, inode = excluded.inode, '
+            'device = excluded.device, ctime_ns = excluded.ctime_ns',
+            (tuple(k) + (s, h, m, f) +
+             (tuple(sig[1:]) if sig else (None,) * 4)
+             for s, h, k, m, f, sig in rows))
+
+    def set_hash(self, size, key, hash_value):
+        self.set_hashes(((size, key, hash_value),))
+
+    def remove_references(self, keys):
+        self._db.executemany(
+            'DELETE FROM files WHERE dir = ? AND name = ?',
+            (tuple(k) for k in keys))
+
+    def set_hashes(self, rows):
+        self._db.executemany(
+            'UPDATE files SET hash = ? WHERE dir = ? AND name = ? AND size = ?',
+            ((h,) + tuple(k) + (s,) for s, k, h in rows))
+
+    def entries_after(self, key, count):
+        if key is None:
+            key = (-1, -1)
+        return [((r[0], r[1]), r[2], r[3]) for r in self._db.execute(
+            'SELECT dir, name, size, mtime_ns FROM files '
+            'WHERE (dir, name) > (?, ?) ORDER BY dir, name LIMIT ?',
+            tuple(key) + (count,))]
+
+    def collapse_sizes(self, sizes):
+        _collapsed = 0
+        for _size in sizes:
+            _collapsed += self._db.execute(
+                'UPDATE files SET hash = NULL, fingerprint = NULL, '
+                'mdate = NULL WHERE size = ? AND (SELECT COUNT(*) FROM files '
+                'WHERE size = ?) = 1 AND (hash IS NOT NULL OR '
+                'fingerprint IS NOT NULL)', (_size, _size)).rowcount
+        return _collapsed
+
+    def used_directories(self):
+        return {r[0] for r in self._db.execute(
+            'SELECT DISTINCT dir FROM files')}
+
+    def remove_nodes(self, nodes):
+        self._db.executemany(
+            'DELETE FROM nodes WHERE id = ?', ((n,) for n in nodes))
+
+    def entry(self, size, key):
+        return self._db.execute(
+            'SELECT hash, fingerprint, mdate FROM files '
+            'WHERE dir = ? AND name = ? AND size = ?',
+            tuple(key) + (size,)).fetchone()
+
+    def references(self, size, hash_value):
+        return {(r[0], r[1]): r[2] for r in self._db.execute(
+            'SELECT dir, name, mdate FROM files WHERE size = ? AND hash = ?',
+            (size, hash_value))}
+
+    def fingerprint_peers(self, size, fingerprint):
+        return {(r[0], r[1]): r[2:] for r in self._db.execute(
+            'SELECT dir, name, hash, mdate FROM files '
+            'WHERE size = ? AND (fingerprint = ? OR fingerprint IS NULL)',
+            (size, fingerprint))}
+
+    def inode_peers(self, inode_signature):
+        return {(r[0], r[1]): r[2:] for r in self._db.execute(
+            'SELECT dir, name, hash, fingerprint FROM files '
+            'WHERE size = ? AND mtime_ns = ? AND inode = ? AND device = ?',
+            tuple(inode_signature))}
+
+    def signatures(self, pre, post):
+        return {(r[0], r[1]): r[2:] for r in self._db.execute(
+            'SELECT f.dir, f.name, f.size, f.mtime_ns, f.inode, f.device, '
+            'f.ctime_ns FROM nodes n JOIN files f ON f.dir = n.id '
+            'WHERE n.pre BETWEEN ? AND ? AND f.mtime_ns IS NOT NULL',
+            (pre, post))}
+
+    def files_below(self, pre, post):
+        for _row in self._db.execute(
+                'SELECT f.dir, f.name, f.size, f.hash, f.fingerprint, '
+                'f.mtime_ns FROM nodes n JOIN files f ON f.dir = n.id '
+                'WHERE n.pre BETWEEN ? AND ?', (pre, post)):
+            yield (_row[:2],) + _row[2:]
+
+    def copies_outside(self, pre, post):
+        for _row in self._db.execute(
+                'SELECT f.dir, f.name, o.dir, o.name, o.mtime_ns, '
+                'o.inode = f.inode AND o.device = f.device '
+                'AND o.mtime_ns = f.mtime_ns '
+                'FROM nodes n JOIN files f ON f.dir = n.id '
+                'JOIN files o INDEXED BY files_hash '
+                'ON o.hash = f.hash AND o.size = f.size '
+                'JOIN nodes m ON m.id = o.dir '
+                'WHERE n.pre BETWEEN ? AND ? '
+                'AND m.pre NOT BETWEEN ? AND ?', (pre, post, pre, post)):
+            yield _row[:2], _row[2:4], _row[4], bool(_row[5])
+
+    def nodes(self):
+        return self._db.execute(
+            'SELECT id, parent, name, pre, post FROM nodes').fetchall()
+
+    def store_node(self, node, parent, name):
+        self._db.execute(
+            'INSERT INTO nodes (id, parent, name) VALUES (?, ?, ?)',
+            (node, parent, name))
+
+    def store_numbering(self, numbers):
+        self._db.executemany(
+            'UPDATE nodes SET pre = ?, post = ? WHERE id = ?', numbers)
+
+    def stale_nodes(self):
+        return [r[0] for r in self._db.execute('SELECT id FROM stale_nodes')]
+
+    def files_in(self, node):
+        return self._db.execute(
+            'SELECT name, size, hash, fingerprint FROM files WHERE dir = ?',
+            (node,)).fetchall()
+
+    def subdirectories(self, node):
+        return self._db.execute(
+            'SELECT id, name, digest, unnamed_digest FROM nodes '
+            'WHERE parent = ?', (node,)).fetchall()
+
+    def store_digests(self, rows):
+        rows = list(rows)
+        self._db.executemany(
+            'UPDATE nodes SET digest = ?, unnamed_digest = ? WHERE id = ?',
+            rows)
+        self._db.executemany(
+            'DELETE FROM stale_nodes WHERE id = ?', ((r[2],) for r in rows))
+
+    def duplicate_nodes(self, ignore_names=False):
+        _column = 'unnamed_digest' if ignore_names else 'digest'
+        _result = collections.defaultdict(list)
+        for _digest, _node in self._db.execute(
+                'SELECT {0}, id FROM nodes WHERE {0} IN ('
+                "SELECT {0} FROM nodes WHERE {0} IS NOT NULL AND {0} != '' "
+                'GROUP BY {0} HAVING COUNT(*) > 1)'.format(_column)):
+            _result[_digest].append(_node)
+        return _result
 
-    def is_normal_file(self):
-        return (os.path.isfile(self._fullname) and
-                not os.path.islink(self._fullname))
+    def equal_nodes(self, pre, post, other_pre, other_post):
+        return {r[0] for r in self._db.execute(
+            'SELECT id FROM nodes WHERE pre BETWEEN ? AND ? '
+            "AND unnamed_digest IS NOT NULL AND unnamed_digest != '' "
+            'AND unnamed_digest IN (SELECT unnamed_digest FROM nodes '
+            'WHERE pre BETWEEN ? AND ? '
+            "AND unnamed_digest IS NOT NULL AND unnamed_digest != '')",
+            (pre, post, other_pre, other_post))}
+
+    def get_meta(self, key):
+        _row = self._db.execute(
+            'SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return None if _row is None else _row[0]
+
+    def set_meta(self, key, value):
+        if value is None:
+            self._db.execute('DELETE FROM meta WHERE key = ?', (key,))
+        else:
+            self._db.execute(
+                'INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+    def is_empty(self):
+        return self._db.execute(
+            'SELECT 1 FROM files LIMIT 1').fetchone() is None
+
+    def all_entries(self):
+        return [((r[0], r[1]), r[2], r[3]) for r in self._db.execute(
+            'SELECT dir, name, size, hash FROM files')]
+
+    def check(self):
+        return [r[0] for r in self._db.execute('PRAGMA quick_check')
+                if r[0] != 'ok']
+
+    def storage_size(self):
+        return (self._db.execute('PRAGMA page_count').fetchone()[0] *
+                self._db.execute('PRAGMA page_size').fetchone()[0])
+
+    def compact(self):
+        self._db.commit()
+        self._db.execute('VACUUM')
+
+    def data_version(self):
+        return self._db.execute('PRAGMA data_version').fetchone()[0]
+
+    def remove_names_from(self, count):
+        _removed = self._db.execute(
+            'DELETE FROM files WHERE name >= ?', (count,)).rowcount
+        self._db.execute('DELETE FROM nodes WHERE name >= ?', (count,))
+        while self._db.execute(
+                'DELETE FROM nodes WHERE parent IS NOT NULL AND parent NOT IN '
+                '(SELECT id FROM nodes)').rowcount:
+            pass
+        _removed += self._db.execute(
+            'DELETE FROM files WHERE dir NOT IN (SELECT id FROM nodes)'
+        ).rowcount
+        return _removed
+
+    def commit(self):
+        with _translate_busy_error():
+            self._db.commit()
+
+    def rollback(self):
+        self._db.rollback()
+
+    def close(self):
+        self._db.close()
+
+
+index_backends = {
+    'sqlite': sqlite_backend,
+}
+
+
+class write_behind_backend(index_backend):
+    ''' collects the mutations of another backend in memory and writes
+        them in batches grouped by file size. Reading a size with pending
+        mutations writes those first, everything else which reads more than
+        one size writes all of them. Pending mutations get written when
+        there are more than <max_pending> or the oldest one is older than
+        <flush_interval> seconds
+    '''
+
+    def __init__(self, backend, max_pending=10000, flush_interval=5.0):
+        self._backend = backend
+        self._max_pending = max_pending
+        self._flush_interval = flush_interval
+        self._pending = collections.OrderedDict()
+        self._pending_count = 0
+        self._oldest = None
+
+    def _stage(self, size, operation, row):
+        _operations = self._pending.setdefault(size, [])
+        if _operations and _operations[-1][0] == operation:
+            _operations[-1][1].append(row)
+        else:
+            _operations.append((operation, [row]))
+        self._pending_count += 1
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+        if (self._pending_count >= self._max_pending or
+                time.monotonic() - self._oldest >= self._flush_interval):
+            self.flush()
+
+    def _flush_size(self, size):
+        _operations = self._pending.pop(size, None)
+        if _operations is None:
+            return
+        for _operation, _rows in _operations:
+            if _operation == 'reference':
+                self._backend.store_references(_rows)
+            else:
+                self._backend.set_hashes(_rows)
+            self._pending_count -= len(_rows)
+
+    def flush(self):
+        ''' writes all pending mutations - sorted by size '''
+        for _size in sorted(self._pending):
+            self._flush_size(_size)
+        self._oldest = None
+
+    def size_state(self, size):
+        self._flush_size(size)
+        return self._backend.size_state(size)
+
+    def store_single(self, size, key, signature=None):
+        self.store_reference(size, None, key, None, signature=signature)
+
+    def store_reference(self, size, hash_value, key, mdate,
+                        fingerprint=None, signature=None):
+        self._stage(size, 'reference',
+                    (size, hash_value, key, mdate, fingerprint, signature))
+
+    def set_hash(self, size, key, hash_value):
+        self._stage(size, 'hash', (size, key, hash_value))
+
+    def remove_references(self, keys):
+        self.flush()
+        self._backend.remove_references(keys)
+
+    def entries_after(self, key, count):
+        self.flush()
+        return self._backend.entries_after(key, count)
+
+    def collapse_sizes(self, sizes):
+        self.flush()
+        return self._backend.collapse_sizes(sizes)
+
+    def used_directories(self):
+        self.flush()
+        return self._backend.used_directories()
+
+    def remove_nodes(self, nodes):
+        self._backend.remove_nodes(nodes)
+
+    def entry(self, size, key):
+        self._flush_size(size)
+        return self._backend.entry(size, key)
+
+    def references(self, size, hash_value):
+        self._flush_size(size)
+        return self._backend.references(size, hash_value)
+
+    def fingerprint_peers(self, size, fingerprint):
+        self._flush_size(size)
+        return self._backend.fingerprint_peers(size, fingerprint)
+
+    def inode_peers(self, inode_signature):
+        self._flush_size(inode_signature[0])
+        return self._backend.inode_peers(inode_signature)
+
+    def signatures(self, pre, post):
+        self.flush()
+        return self._backend.signatures(pre, post)
+
+    def files_below(self, pre, post):
+        self.flush()
+        return self._backend.files_below(pre, post)
+
+    def copies_outside(self, pre, post):
+        self.flush()
+        return self._backend.copies_outside(pre, post)
+
+    def nodes(self):
+        return self._backend.nodes()
+
+    def store_node(self, node, parent, name):
+        self._backend.store_node(node, parent, name)
+
+    def store_numbering(self, numbers):
+        self._backend.store_numbering(numbers)
+
+    def stale_nodes(self):
+        self.flush()
+        return self._backend.stale_nodes()
+
+    def files_in(self, node):
+        self.flush()
+        return self._backend.files_in(node)
+
+    def subdirectories(self, node):
+        return self._backend.subdirectories(node)
+
+    def store_digests(self, rows):
+        self._backend.store_digests(rows)
+
+    def duplicate_nodes(self, ignore_names=False):
+        return self._backend.duplicate_nodes(ignore_names)
+
+    def equal_nodes(self, pre, post, other_pre, other_post):
+        return self._backend.equal_nodes(pre, post, other_pre, other_post)
+
+    def get_meta(self, key):
+        return self._backend.get_meta(key)
 
-    def packed_path(self):
-        ''' turn "/home/user/some/directory" into index based string
-            e.g. "2.7.4.9"'''
-        #todo: assert: '/{}'" not in path
-        if self._packed_path is None:
-            assert self._word_store is not None
-            self._packed_path = self._word_store.get_packed(self._fullname)
-        return self._packed_path
+    def set_meta(self, key, value):
+        self._backend.set_meta(key, value)
+
+    def is_empty(self):
+        self.flush()
+        return self._backend.is_empty()
+
+    def all_entries(self):
+        self.flush()
+        return self._backend.all_entries()
+
+    def check(self):
+        self.flush()
+        return self._backend.check()
+
+    def storage_size(self):
+        return self._backend.storage_size()
+
+    def compact(self):
+        self.flush()
+        self._backend.compact()
+
+    def data_version(self):
+        return self._backend.data_version()
+
+    def remove_names_from(self, count):
+        self.flush()
+        return self._backend.remove_names_from(count)
+
+    def commit(self):
+        self.flush()
+        self._backend.commit()
+
+    def rollback(self):
+        self._pending.clear()
+        self._pending_count = 0
+        self._oldest = None
+        self._backend.rollback()
+
+    def close(self):
+        self._backend.close()
+
+
+class instrumented_backend:
+    ''' forwards to an index_backend and accounts the time and the number of
+        calls of every primitive to a run_stats instance '''
+
+    _writing = {'store_single', 'store_reference', 'set_hash', 'store_node',
+                'store_numbering', 'set_meta', 'remove_names_from', 'commit',
+                'rollback', 'flush', 'remove_references', 'store_digests',
+                'collapse_sizes', 'remove_nodes', 'compact'}
+
+    def __init__(self, backend, stats):
+        self._backend = backend
+        self._stats = stats
+
+    def __getattr__(self, name):
+        _attr = getattr(self._backend, name)
+        if name.startswith('_') or not callable(_attr):
+            return _attr
+        _phase = 'index_write' if name in self._writing else 'index_read'
+        _counter = 'index_' + name
+
+        def _timed(*args, **kwargs):
+            _start = time.perf_counter()
+            try:
+                return _attr(*args, **kwargs)
+            finally:
+                self._stats.add_time(
+                    _phase, time.perf_counter() - _start, _counter)
+
+        setattr(self, name, _timed)
+        return _timed
+
+
+class legacy_index:
+    ''' read access to the directory based index layout used by earlier
+        versions of fsi (one directory per size digit, a 'dirinfo' file,
+        one file per hash and one symlink per packed path) '''
+
+    def __init__(self, bysize_dir):
+        self._bysize_dir = bysize_dir
+
+    def exists(self):
+        return os.path.isdir(self._bysize_dir)
+
+    def entries(self):
+        ''' yields (size, hash, packed_path, mdate) tuples - hash and mdate
+            are None for single entries '''
+        for (_dir, _, files) in os.walk(self._bysize_dir):
+            if 'dirinfo' not in files:
+                continue
+            _size = int(os.path.relpath(_dir, self._bysize_dir).replace('/', ''))
+            _dirinfo = legacy_index._read_dirinfo(_dir)
+            if _dirinfo[0] == 'single':
+                yield _size, None, _dirinfo[1], None
+                continue
+            assert _dirinfo[0] == 'multi'
+            for fname in files:
+                _path = os.path.join(_dir, fname)
+                if fname == 'dirinfo' or os.path.islink(_path):
+                    continue
+                for _packed_path, _mdate in legacy_index._hashed_files(
+                        _path).items():
+                    yield _size, fname, _packed_path, _mdate
+
+    def remove(self):
+        rmdirs(self._bysize_dir)
+
+    @staticmethod
+    def _read_dirinfo(directory):
+        return fopen(os.path.join(directory, 'dirinfo')).readline().split(' ')
+
+    @staticmethod
+    def _hashed_files(filename):
+        _lines = (l.strip().split() for l in fopen(filename).readlines())
+        return {h.strip(): d.strip() for h, d in _lines}
+
+
+def _with_add_lock(method):
+    ''' lets an indexer method which modifies the index run with the add
+        lock held (see indexer._add_lock()) '''
+    @functools.wraps(method)
+    def _locked(self, *args, **kwargs):
+        with self._add_lock():
+            return method(self, *args, **kwargs)
+    return _locked
 
 
 class indexer:
 
     class name_component_store:
+        ''' maps path components to numbers. Persisted in an append-only file
+            of NUL terminated, utf-8 encoded words - the n-th word in the file
+            has index n '''
 
         def __init__(self):
-            self._idx_to_word = {}
+            self._idx_to_word = []
             self._word_to_idx = {}
-            self._size = 0
-            self._dirty = False
+            # number of words / bytes already stored in the file
+            self._stored_count = 0
+            self._stored_bytes = 0
 
         def __len__(self):
-            return self._size
+            return len(self._idx_to_word)
+
+        def has_unsaved_words(self):
+            return self._stored_count != len(self._idx_to_word)
 
         def _get_index(self, word, const):
             assert word != ''
@@ -187,51 +1517,82 @@ class indexer:
                 return self._word_to_idx[word]
             if const:
                 raise not_indexed_error()
-            self._dirty = True
-            _index = self._size
-            self._size += 1
+            _index = len(self._idx_to_word)
             self._word_to_idx[word] = _index
-            self._idx_to_word[_index] = word
+            self._idx_to_word.append(word)
             return _index
 
-        def get_packed(self, path, const=False):
-            return '.'.join(
-                (str(self._get_index(n, const))
-                 for n in path[1:].split('/')))
-
-        def restore(self, packed_path):
-            ''' opposite of _get_name_components(): restores the original path
-                on the filesystem '''
-            return '/' + '/'.join((
-                self[i] for i in (int(c) for c in packed_path.split('.'))))
-
         def __getitem__(self, index):
             return self._idx_to_word[index]
 
         def save(self, filename):
-            if self._dirty:
-                dump_json(self._word_to_idx, filename)
-            self._dirty = False
+            ''' appends all words which have not been stored yet '''
+            if self._stored_count == len(self._idx_to_word):
+                return
+            try:
+                _file_size = os.path.getsize(filename)
+            except OSError:
+                _file_size = 0
+            if _file_size != self._stored_bytes:
+                # either a record torn by a crash or another process has
+                # added words which would get the same indices as ours
+                with fopen(filename, 'r+b', -1) as _file:
+                    _file.seek(self._stored_bytes)
+                    if b'\0' in _file.read():
+                        raise index_format_error(
+                            '"%s" has been modified by another process' %
+                            filename)
+                    _file.truncate(self._stored_bytes)
+
+            _data = b''.join(
+                w.encode('utf-8', 'surrogateescape') + b'\0'
+                for w in self._idx_to_word[self._stored_count:])
+            with fopen(filename, 'ab', -1) as _file:
+                _file.write(_data)
+            self._stored_count = len(self._idx_to_word)
+            self._stored_bytes += len(_data)
 
         def load(self, filename):
-            _idx2word = {}
+            ''' reads all words stored after the ones known already '''
+            assert self._stored_count == len(self._idx_to_word)
             try:
-                _word2idx = load_json(filename)
+                _file = fopen(filename, 'rb', -1)
             except file_not_found_error:
                 # file does not exist - just exit
                 return
+            with _file:
+                _file.seek(self._stored_bytes)
+                _data = _file.read()
+            # an incomplete last record (torn by a crash) gets ignored
+            _end = _data.rfind(b'\0') + 1
+            if _end == 0:
+                return
+            _words = _data[:_end - 1].decode(
+                'utf-8', 'surrogateescape').split('\0')
+            self._word_to_idx.update(
+                zip(_words, range(len(self._idx_to_word), 1 << 62)))
+            self._idx_to_word.extend(_words)
+            self._stored_count = len(self._idx_to_word)
+            self._stored_bytes += _end
+
+        def import_json(self, filename):
+            ''' reads words from a JSON file as written by export() '''
+            assert len(self._idx_to_word) == 0
+            _word2idx = load_json(filename)
+            self._idx_to_word = [None] * len(_word2idx)
             for word, idx in _word2idx.items():
-                _idx2word[idx] = word
-            self._idx_to_word, self._word_to_idx, self._size = (
-                _idx2word, _word2idx, len(_idx2word))
+                self._idx_to_word[idx] = word
+            self._word_to_idx = _word2idx
+
+        def export(self, filename):
+            ''' write all words as sorted, human readable JSON '''
+            dump_json(self._word_to_idx, filename)
 
         def __eq__(self, other):
-            if (self._size == other._size and
-                self._idx_to_word == other._idx_to_word and
+            if (self._idx_to_word == other._idx_to_word and
                 self._word_to_idx == other._word_to_idx):
                 return True
             else:
-                print(self._size, other._size)
                 print(len(self._idx_to_word), len(other._idx_to_word))
                 print(len(self._word_to_idx), len(other._word_to_idx))
                 k1 = sorted(self._word_to_idx.keys())
@@ -240,7 +1601,207 @@ class indexer:
                     print(k1[i], k2[i])
                 return False
 
-    def __init__(self, storage_dir='~/.fsi'):
+    class directory_table:
+        ''' all directories containing indexed files as a tree of nodes
+            (node id -> parent id + name component index). Files are
+            identified by a key (node id of their directory, name index).
+            The nodes get numbered in pre order with <post> being the
+            highest number inside a node's subtree, so checking whether a
+            directory is located below another one takes constant time.
+            Every subtree has some unused numbers at its end so new
+            directories can be numbered without renumbering the others
+        '''
+
+        ROOT = 0
+        # unused numbers at the end of every subtree after all nodes have
+        # been (re)numbered
+        GAP = 1 << 16
+
+        def __init__(self, names, backend):
+            self._names = names
+            self._backend = backend
+            self._parent = {}
+            self._name = {}
+            self._child = {}
+            self._pre = {}
+            self._post = {}
+            self._path_cache = {}
+            self._dirty = False
+            for _node, _parent, _name, _pre, _post in backend.nodes():
+                self._insert(_node, _parent, _name)
+                self._pre[_node], self._post[_node] = _pre, _post
+                self._dirty |= _pre is None
+            self._next_id = max(self._parent, default=-1) + 1
+            if self.ROOT not in self._parent:
+                self._create(None, None)
+
+        def __len__(self):
+            return len(self._parent)
+
+        def __contains__(self, node):
+            return node in self._parent
+
+        def parent(self, node):
+            return self._parent[node]
+
+        def _insert(self, node, parent, name):
+            self._parent[node] = parent
+            self._name[node] = name
+            if parent is not None:
+                self._child[(parent, name)] = node
+
+        def _create(self, parent, name):
+            _node = self._next_id
+            self._next_id += 1
+            self._insert(_node, parent, name)
+            self._backend.store_node(_node, parent, name)
+            self._dirty = True
+            return _node
+
+        def _child_node(self, node, name, const):
+            _child = self._child.get((node, name))
+            if _child is None:
+                if const:
+                    raise not_indexed_error()
+                _child = self._create(node, name)
+            return _child
+
+        def node(self, path, const=False):
+            ''' returns the node id of directory <path> and creates missing
+                nodes - or raises not_indexed_error if <const> is set '''
+            _node = self._path_cache.get(path)
+            if _node is None:
+                _node = self.ROOT
+                try:
+                    for _component in path.split('/'):
+                        if _component:
+                            _node = self._child_node(
+                                _node,
+                                self._names._get_index(_component, const),
+                                const)
+                except not_indexed_error:
+                    raise not_indexed_error(path=path) from None
+                self._path_cache[path] = _node
+            return _node
+
+        def key(self, path, const=False):
+            ''' returns the key (directory node, name index) of a file '''
+            _dir, _name = os.path.split(path)
+            try:
+                return (self.node(_dir, const),
+                        self._names._get_index(_name, const))
+            except not_indexed_error:
+                raise not_indexed_error(path=path) from None
+
+        def key_from_packed(self, packed_path):
+            ''' returns the key of a file given as packed path (name indices
+                separated by dots) as used by earlier index formats '''
+            _indices = [int(c) for c in packed_path.split('.')]
+            _node = self.ROOT
+            for _name in _indices[:-1]:
+                _node = self._child_node(_node, _name, False)
+            return _node, _indices[-1]
+
+        def dir_path(self, node):
+            _components = []
+            while node != self.ROOT:
+                _components.append(self._names[self._name[node]])
+                node = self._parent[node]
+            return '/' + '/'.join(reversed(_components))
+
+        def restore(self, key):
+            ''' opposite of key(): restores the original path on the
+                filesystem '''
+            return os.path.join(self.dir_path(key[0]), self._names[key[1]])
+
+        def renumber(self):
+            ''' numbers the nodes which have been added since the last call
+                using the unused numbers of their parents - or renumbers
+                all nodes if there are not enough left. Stores the numbers
+                which have changed '''
+            if not self._dirty:
+                return
+            _children = collections.defaultdict(list)
+            for (_parent, _), _node in self._child.items():
+                _children[_parent].append(_node)
+            _numbers = self._number_new_nodes(_children)
+            if _numbers is None:
+                _numbers = {}
+                self._number_subtree(
+                    _children, self.ROOT, 0, self.GAP, _numbers)
+            _numbers = {n: v for n, v in _numbers.items()
+                        if v != (self._pre.get(n), self._post.get(n))}
+            self._backend.store_numbering(
+                (_pre, _post, n) for n, (_pre, _post) in _numbers.items())
+            for _node, (_pre, _post) in _numbers.items():
+                self._pre[_node], self._post[_node] = _pre, _post
+            self._dirty = False
+
+        def _number_new_nodes(self, children):
+            ''' returns {node: (pre, post)} for all nodes without numbers
+                taken from the unused numbers of their (numbered) parents -
+                None if that's not possible '''
+            _new = collections.defaultdict(list)
+            for _node, _parent in self._parent.items():
+                if self._pre.get(_node) is not None:
+                    continue
+                if _parent is None:
+                    return None
+                if self._pre.get(_parent) is not None:
+                    _new[_parent].append(_node)
+            _numbers = {}
+            for _parent, _nodes in _new.items():
+                _start = max([self._pre[_parent]] + [
+                    self._post[c] for c in children[_parent]
+                    if self._pre.get(c) is not None]) + 1
+                _count = 0
+                _stack = list(_nodes)
+                while _stack:
+                    _count += 1
+                    _stack.extend(children[_stack.pop()])
+                # use at most half of the unused numbers - later siblings
+                # need some, too
+                _step = (self._post[_parent] - _start + 1) // 2 // _count
+                if _step < 2:
+                    return None
+                for _node in _nodes:
+                    _start = self._number_subtree(
+                        children, _node, _start, _step - 1, _numbers)
+            return _numbers
+
+        @staticmethod
+        def _number_subtree(children, node, start, gap, numbers):
+            ''' numbers <node> and all nodes below in pre order beginning
+                with <start> and leaves <gap> numbers unused at the end of
+                every subtree - returns the next unused number '''
+            _counter = start
+            _stack = [(node, True)]
+            while _stack:
+                _node, _enter = _stack.pop()
+                if _enter:
+                    numbers[_node] = (_counter, None)
+                    _counter += 1
+                    _stack.append((_node, False))
+                    _stack.extend((c, True) for c in children[_node])
+                else:
+                    _counter += gap
+                    numbers[_node] = (numbers[_node][0], _counter - 1)
+            return _counter
+
+        def interval(self, node):
+            ''' returns the range of numbers of all nodes below <node> '''
+            self.renumber()
+            return self._pre[node], self._post[node]
+
+        def is_below(self, node, ancestor):
+            ''' True if directory <node> is <ancestor> or located below '''
+            self.renumber()
+            return (self._pre[ancestor] <= self._pre[node]
+                    <= self._post[ancestor])
+
+    def __init__(self, storage_dir='~/.fsi', backend='sqlite', jobs=1,
+                 walkers=1, hash_algorithm=None, stats=None,
+                 write_buffer=10000, flush_interval=5.0):
         _storage_dir = os.path.expanduser(storage_dir)
         self._ignore_pattern = ('.git', '.svn', '__pycache__', '.fsi')
         try:
@@ -248,14 +1809,221 @@ class indexer:
         except path_exists_error:
             pass
 
-        self._bysize_dir = os.path.join(_storage_dir, 'sizes')
-        self._name_file = os.path.join(_storage_dir, 'name_parts.txt')
-        self._name_component_store = indexer.name_component_store()
+        self._stats = stats if stats is not None else run_stats()
+        self._legacy_index = legacy_index(os.path.join(_storage_dir, 'sizes'))
+        with self._stats.timed('index_open'):
+            self._backend = index_backends[backend](_storage_dir)
+        if write_buffer > 0:
+            self._backend = write_behind_backend(
+                self._backend, write_buffer, flush_interval)
+        if stats is not None:
+            # accounting every index access costs noticeable time for
+            # small files - so it's only done on request
+            self._backend = instrumented_backend(self._backend, stats)
+        self._hash_engine = hash_engine(
+            jobs, self._check_hash_algorithm(hash_algorithm), self._stats)
+        self._walk_pool = None
+        if walkers > 1:
+            import concurrent.futures
+            self._walk_pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=walkers)
+        self._walk_lookahead = 4 * walkers
+        self._counters = collections.Counter()
+        self._name_file = os.path.join(_storage_dir, 'name_parts.dat')
         self._tracked_dirs_filename = os.path.join(_storage_dir, 'tracked_dirs')
-
-        self._name_component_store.load(self._name_file)
+        self._add_lock_filename = os.path.join(_storage_dir, 'add.lock')
+        self._add_lock_held = False
+        # set once the add lock has been taken - see __exit__()
+        self._modified = False
+        # loaded on first access - see the properties below
+        self._names = None
+        self._directory_table = None
+
+        _json_name_file = os.path.join(_storage_dir, 'name_parts.txt')
+        if (os.path.exists(_json_name_file) and
+                not os.path.exists(self._name_file)):
+            # convert the JSON file written by earlier versions
+            self._names = indexer.name_component_store()
+            self._names.import_json(_json_name_file)
+            self._names.save(self._name_file)
+            os.remove(_json_name_file)
+        if (self._backend.get_meta('add_journal') is not None and
+                not self._add_running()):
+            # the index gets repaired by the next command which writes
+            logging.warning('adding "%s" has been interrupted - use '
+                            '`fsi add --resume` to continue',
+                            self.interrupted_add())
         self._tracked_directories = self._load_tracked_dir_list()
 
+        self._data_version = self._backend.data_version()
+
+        if self._legacy_index.exists() and self._backend.is_empty():
+            logging.warning('found an index in the old directory based '
+                            'format - please run `fsi migrate`')
+
+    @property
+    def _name_component_store(self):
+        if self._names is None:
+            with self._stats.timed('names_read'):
+                self._names = indexer.name_component_store()
+                self._names.load(self._name_file)
+        return self._names
+
+    @property
+    def _directories(self):
+        if self._directory_table is None:
+            _names = self._name_component_store
+            with self._stats.timed('nodes_read'):
+                self._directory_table = indexer.directory_table(
+                    _names, self._backend)
+        return self._directory_table
+
+    @contextlib.contextmanager
+    def _add_lock(self):
+        ''' held while the index gets modified by add (or gc, migrate, ..)
+            so an add journal can be told apart from a crashed add: the
+            lock vanishes together with the process holding it '''
+        if self._add_lock_held:
+            yield
+            return
+        try:
+            import fcntl
+        except ImportError:
+            fcntl = None
+        with open(self._add_lock_filename, 'a') as _file:
+            try:
+                if fcntl is not None:
+                    fcntl.flock(_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logging.warning('waiting for another process (pid %s) to '
+                                'finish adding', self._journal().get('pid'))
+                fcntl.flock(_file, fcntl.LOCK_EX)
+            self._add_lock_held = True
+            self._modified = True
+            try:
+                if self._backend.get_meta('add_journal') is not None:
+                    self._recover()
+                yield
+            finally:
+                self._add_lock_held = False
+
+    def _add_running(self):
+        ''' True if another process holds the add lock right now '''
+        try:
+            import fcntl
+        except ImportError:
+            return False
+        with open(self._add_lock_filename, 'a') as _file:
+            try:
+                fcntl.flock(_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+        return False
+
+    def _recover(self):
+        ''' repairs the index after an add has been interrupted. The index
+            itself only contains complete files (see _checkpoint()) but
+            entries might refer to names which never made it to disk.
+            Must only be called with the add lock held '''
+        _problems = self._backend.check()
+        if _problems:
+            raise index_format_error(
+                'index is damaged: %s' % '; '.join(_problems[:3]))
+        _removed = self._backend.remove_names_from(
+            len(self._name_component_store))
+        if _removed:
+            logging.warning('removed %d entries with unknown names', _removed)
+        self._backend.commit()
+
+    def refresh(self):
+        ''' picks up changes other processes have made to the index since it
+            has been opened (e.g. for a long running `fsi serve`). Words
+            which have been added but not saved get dropped '''
+        _version = self._backend.data_version()
+        _unsaved = (self._names is not None and
+                    self._names.has_unsaved_words())
+        if _version == self._data_version and not _unsaved:
+            return
+        if _unsaved:
+            self._names = None
+        elif self._names is not None:
+            self._names.load(self._name_file)
+        self._directory_table = None
+        self._data_version = _version
+
+    def _journal(self):
+        ''' returns the journal of a running or interrupted add (see
+            add_paths()) - empty if there is none '''
+        _journal = self._backend.get_meta('add_journal')
+        return {} if _journal is None else json.loads(_journal)
+
+    def _journal_positions(self):
+        ''' returns {path: position} of the paths of an interrupted add (see
+            _walk_files()) - empty if there is none '''
+        _journal = self._journal()
+        if not _journal:
+            return {}
+        if 'positions' not in _journal:
+            # written by add() of a single path before
+            return {_journal['path']: _journal['position']}
+        return dict(_journal['positions'])
+
+    def interrupted_add(self):
+        ''' returns the path of an interrupted add (the first one if several
+            have been added together) or None '''
+        return next(iter(self.interrupted_paths()), None)
+
+    def interrupted_paths(self):
+        ''' returns all paths of an interrupted add '''
+        return list(self._journal_positions())
+
+    def _checkpoint(self, journal):
+        ''' makes all changes durable which have been made so far together
+            with the position of the currently running add (<journal>) -
+            must only be called between two files. Names get written first
+            so committed entries never refer to unknown names '''
+        if self._names is not None:
+            self._names.save(self._name_file)
+        self._save_tracked_dir_list()
+        self._backend.set_meta(
+            'add_journal', None if journal is None else json.dumps(journal))
+        self._backend.commit()
+
+    def stats(self):
+        ''' returns the times and counters collected so far as a dict '''
+        return self._stats.as_dict()
+
+    def _check_hash_algorithm(self, requested):
+        ''' returns the hash algorithm used by the index - a new index will
+            use <requested> (or sha1). Hashes of different algorithms can't
+            be compared so an existing index refuses to use another one '''
+        _used = self._backend.get_meta('hash_algorithm')
+        if _used is None:
+            # indexes without this information use sha1 - it gets stored
+            # when files get added (see _store_hash_algorithm()) so opening
+            # an index doesn't write
+            if self._backend.is_empty() and requested is not None:
+                _used = requested
+            else:
+                _used = 'sha1'
+        if requested is not None and requested != _used:
+            raise index_format_error(
+                'index uses %s hashes - cannot use %s' % (_used, requested))
+        if _used not in HASH_ALGORITHMS:
+            raise index_format_error(
+                'index uses %s hashes which are not available' % _used)
+        return _used
+
+    def hash_algorithm(self):
+        return self._hash_engine.algorithm()
+
+    def _store_hash_algorithm(self):
+        if self._backend.get_meta('hash_algorithm') is None:
+            self._backend.set_meta('hash_algorithm', self.hash_algorithm())
+
+    def export_names(self, filename):
+        self._name_component_store.export(filename)
+
     def tracked_dir_list(self) -> list:
         return self._tracked_directories
 
@@ -263,8 +2031,8 @@ class indexer:
         try:
             _result = load_json(self._tracked_dirs_filename)
         except file_not_found_error:
-            # todo: assert isempty(self._bysize_dir)
-            assert not os.path.exists(self._name_file)
+            # a new index (or one written by a version which didn't save
+            # the list on checkpoints)
             _result = []
 
         assert isinstance(_result, list)
@@ -277,70 +2045,74 @@ class indexer:
         return self
 
     def __exit__(self, data_type, value, tb):
-        if DEBUG_MODE:
+        if not self._modified:
+            # only commands holding the add lock modify the index - words
+            # and nodes created by lookups of a query must not get saved
+            # (another process might be adding files)
+            pass
+        elif self._names is None:
+            # names haven't been used - nothing to save
+            pass
+        elif DEBUG_MODE:
             # store and load to debug structure for test purposes
             t = time.time()
-            self._name_component_store.save(self._name_file)
+            self._names.save(self._name_file)
             logging.debug("save: %.2fs", time.time() - t)
             _test_store = indexer.name_component_store()
             t = time.time()
             _test_store.load(self._name_file)
             logging.debug("load: %.4fs", time.time() - t)
-            assert _test_store == self._name_component_store
+            assert _test_store == self._names
         else:
-            self._name_component_store.save(self._name_file)
-        self._save_tracked_dir_list()
-
-    @staticmethod
-    def _store_single_file(size_path, name):
-        ''' write a file with meta information about a single file '''
-        with wopen(os.path.join(size_path, 'dirinfo'), 'w') as _f:
-            _f.write("single ")
-            _f.write(name)
-
-    @staticmethod
-    def _read_dirinfo(directory):
-        return fopen(os.path.join(directory, 'dirinfo')).readline().split(' ')
-
-    @staticmethod
-    def _hashed_files(filename):
-        _lines = (l.strip().split() for l in fopen(filename).readlines())
-        # return ((h.strip(), d.strip()) for h, d in _lines)
-        return {h.strip(): d.strip() for h, d in _lines}
-
-    @staticmethod
-    def _write_file_reference(file_obj, file_instance):
-        file_obj.write(file_instance.packed_path())
-        file_obj.write(" ")
-        file_obj.write(file_instance.mdate())
-        file_obj.write("\n")
-
-    def _get_size_path(self, file_instance):
-        ''' returns a tuple with a path representing the file's size and the
-            status of the path.
-            Creates it if not existent. status is 0 for path did not exist yet,
-            1 for path exists with a 'dirinfo' and 1 for path exists with
-            several file information.
-        '''
-        _result = os.path.join(
-            self._bysize_dir,
-            '/'.join('%d' % file_instance.size()))
-
-        try:
-            make_dirs(_result)
-            return (_result, None)
-        except path_exists_error:
-            try:
-                _dirinfo = indexer._read_dirinfo(_result)
-                return (_result, _dirinfo)
-            except file_not_found_error:
-                return (_result, None)
-                # todo: assert existing hash files
+            with self._stats.timed('names_write'):
+                self._names.save(self._name_file)
+        if self._modified:
+            self._save_tracked_dir_list()
+        self._hash_engine.close()
+        if self._walk_pool is not None:
+            self._walk_pool.shutdown(cancel_futures=True)
+        if data_type is None and self._modified:
+            if self._directory_table is not None:
+                with self._stats.timed('nodes_write'):
+                    self._directory_table.renumber()
+            self._backend.commit()
+        else:
+            # changes since the last checkpoint might be incomplete (or
+            # made by a query)
+            self._backend.rollback()
+        self._backend.close()
+
+    @_with_add_lock
+    def migrate(self):
+        ''' copies all entries of an index in the old directory based layout
+            into the current backend and removes the old layout afterwards '''
+        if not self._legacy_index.exists():
+            print('no index in the old format found')
+            return 0
+        if self._hash_engine.algorithm() != 'sha1':
+            raise index_format_error(
+                'the old index format uses sha1 hashes - cannot import into '
+                'an index using %s' % self._hash_engine.algorithm())
+        self._store_hash_algorithm()
+        _count = 0
+        for _size, _hash, _packed_path, _mdate in self._legacy_index.entries():
+            _key = self._directories.key_from_packed(_packed_path)
+            if _hash is None:
+                self._backend.store_single(_size, _key)
+            else:
+                self._backend.store_reference(_size, _hash, _key, _mdate)
+            _count += 1
+        self._directories.renumber()
+        self._backend.commit()
+        self._legacy_index.remove()
+        print('migrated %d file references' % _count)
+        return _count
 
     def _get_state(self, file_instance):
         ''' checks whether the file is indexed and it has duplicates
         '''
-        _size_path, _state = self._get_size_path(file_instance)
+        _size = file_instance.size()
+        _state = self._backend.size_state(_size)
 
         if _state is None:
             return False, None, None
@@ -349,154 +2121,346 @@ class indexer:
                 return True, True, {}
             elif _state[0] == 'multi':
                 try:
-                    _hashed_files = indexer._hashed_files(
-                        os.path.join(_size_path, file_instance.packed_path()))
-                    return True, False, _hashed_files
-                except file_not_found_error:
+                    # queries must not create names or nodes
+                    _key = self._directories.key(
+                        file_instance.path(), const=True)
+                except not_indexed_error:
+                    return True, False, {}
+                _entry = self._backend.entry(_size, _key)
+                if _entry is None:
                     return True, False, {}
+                if _entry[0] is None:
+                    # file is registered by its fingerprint only - no other
+                    # file can have the same content
+                    return True, False, {_key: _entry[2]}
+                return True, False, self._backend.references(_size, _entry[0])
             else:
                 assert False
 
     def _add_file(self, file_instance):
-        _size_path, _state = self._get_size_path(file_instance)
-        _packed_path = file_instance.packed_path()
+        _size = file_instance.size()
+        _state = self._backend.size_state(_size)
+        _key = file_instance.key()
 
         if DEBUG_MODE:
-            assert (self._name_component_store.restore(_packed_path) ==
+            assert (self._directories.restore(_key) ==
                     file_instance.path())
 
-        # logging.debug("%s => %s", filename, _packed_path)
-        # print(_packed_path, _time)
-
         if DEBUG_MODE:
-            assert (sha1_internal(file_instance.path()) ==
-                    sha1_external(file_instance.path()))
-
-        # === no state changing operations before
-        # === red exception safety line ===============================
-        # === no exceptions after
+            with wopen(file_instance.path(), 'rb') as _f:
+                _hash = HASH_ALGORITHMS[self._hash_engine.algorithm()]()
+                _hash.update(_f.read())
+                assert (file_instance.content_hash() == _hash.hexdigest())
+
+        if _state is not None and _state[0] == 'single':
+            _other_file = file_info(
+                self._directories.restore(_state[1]),
+                self._directories, self._hash_engine)
+            try:
+                _other_file.stat()
+            except file_not_found_error:
+                # the only other file with this size does not exist anymore
+                logging.debug('replace vanished file %s', _other_file.path())
+                self._backend.remove_references((_state[1],))
+                _state = None
 
         if _state is None:
             # file size not registered
-            # create a file with file name and modification date
-            indexer._store_single_file(_size_path, _packed_path)
+            self._backend.store_single(
+                _size, _key, file_instance.signature())
         else:
             if _state[0] == 'single':
-                _other_packed_path = _state[1]
-                if _packed_path == _other_packed_path:
-                    # we found the reference to the current file
-                    # so nothing has changed and nothing left to do
-                    pass
+                if _key == _state[1]:
+                    # we found the reference to the current file - there is
+                    # no other file with this size so we only have to
+                    # update its signature
+                    self._backend.store_single(
+                        _size, _key, file_instance.signature())
                 else:
                     # we found another file with the same file - we have
                     # to turn this entry into a multi-entry
-                    #print('collision')
-                    indexer._promote_to_multi(
-                        _size_path,
-                        file_info(
-                            self._name_component_store.restore(_other_packed_path),
-                            self._name_component_store),
-                        file_instance)
+                    self._promote_to_multi(_other_file, file_instance)
 
             elif _state[0] == 'multi':
-                # we found a file size folder which contains one or more file
+                # we found a file size which contains one or more file
                 # references with hashes and modification date so we have to
                 # add the current files' information
-                indexer._update_multi(_size_path, file_instance)
+                self._update_multi(file_instance)
             else:
                 # everything else should not happen
                 assert False
 
-    @staticmethod
-    def _promote_to_multi(size_path, other_file, new_file):
+    def _promote_to_multi(self, other_file, new_file):
         ''' turn a single file entry into a multi file entry
         '''
         # todo raise if any hash cannot be computed
         # todo raise if second file does not exist
 
-        # === red exception safety line ========================================
+        _fingerprints = other_file.fingerprint(), new_file.fingerprint()
+        if _fingerprints[1] is not None:
+            self._counters['fingerprints'] += 2
+            if _fingerprints[0] != _fingerprints[1]:
+                # the files differ already in the sampled content
+                self._counters['full_hashes_avoided'] += 2
+                for _file, _fingerprint in zip((other_file, new_file),
+                                               _fingerprints):
+                    self._backend.store_reference(
+                        _file.size(), None, _file.key(),
+                        _file.mdate(), _fingerprint, _file.signature())
+                return
 
-        dir_info_fn = os.path.join(size_path, 'dirinfo')
-        if new_file.hash_sha1() == other_file.hash_sha1():
+        # compute both hashes before anything gets written
+        _other_hash = other_file.content_hash()
+        _new_hash = new_file.content_hash()
+        self._counters['full_hashes'] += 2
+        if _new_hash == _other_hash:
             logging.debug('found identical: %s %s',
                           new_file.path(), other_file.path())
-            hash_fn = os.path.join(size_path, new_file.hash_sha1())
-            with wopen(dir_info_fn, 'w') as fd, wopen(hash_fn, 'w') as fh1:
-                fd.write('multi')
-                indexer._write_file_reference(fh1, other_file)
-                indexer._write_file_reference(fh1, new_file)
-        else:
-            hash1_fn = os.path.join(size_path, other_file.hash_sha1())
-            hash2_fn = os.path.join(size_path, new_file.hash_sha1())
-            with wopen(dir_info_fn, 'w') as fd, \
-                 wopen(hash1_fn, 'w') as fh1, \
-                 wopen(hash2_fn, 'w') as fh2:
-                fd.write('multi')
-                indexer._write_file_reference(fh1, other_file)
-                indexer._write_file_reference(fh2, new_file)
-
-        os.symlink(other_file.hash_sha1(),
-                   os.path.join(size_path, other_file.packed_path()))
-        os.symlink(new_file.hash_sha1(),
-                   os.path.join(size_path, new_file.packed_path()))
 
-    @staticmethod
-    def _update_multi(size_path, file_instance):
-        ''' we have to update a given dirinfo file. with a given file
-            specification'''
-        assert os.path.exists(os.path.join(size_path, 'dirinfo'))
-
-        # symlink name to hash file e.g. /2/3/7/2/2.6.1.23 -> 410ae0d2bcadca8..
-        _composite_path = os.path.join(size_path, file_instance.packed_path())
-
-        try:
-            # try to read list of file with same hash - might fail when no
-            # duplicate file has been registered yet
-            _hashed_files = indexer._hashed_files(_composite_path)
-        except file_not_found_error:
-            # file does not exist - create it with one entry
-            with wopen(file_instance.hash_file_path(size_path), 'w') as fh:
-                indexer._write_file_reference(fh, file_instance)
-            os.symlink(file_instance.hash_sha1(), _composite_path)
+        self._backend.store_reference(
+            other_file.size(), _other_hash, other_file.key(),
+            other_file.mdate(), _fingerprints[0], other_file.signature())
+        self._backend.store_reference(
+            new_file.size(), _new_hash, new_file.key(),
+            new_file.mdate(), _fingerprints[1], new_file.signature())
+
+    def _update_multi(self, file_instance):
+        ''' add a given file to a size which already has several file
+            references '''
+        _size = file_instance.size()
+        _key = file_instance.key()
+        _entry = self._backend.entry(_size, _key)
+
+        if _entry is not None and _entry[2] == file_instance.mdate():
+            # file reference is up to date - only the signature might be
+            # missing or outdated
+            self._backend.store_reference(
+                _size, _entry[0], _key, _entry[2], _entry[1],
+                file_instance.signature())
             return
 
-        if file_instance.packed_path() in _hashed_files:
-            # check file mdate
-            if _hashed_files[file_instance.packed_path()] == file_instance.mdate():
-                # file reference is up to date - nothing to do
-                pass
-            else:
-                # hash and link correspond but the file could have been altered
-                # since the hash has changed
-                # assert False
-                pass
+        _inode_signature = file_instance.inode_signature()
+        if _inode_signature is not None:
+            for _hash, _fingerprint in self._backend.inode_peers(
+                    _inode_signature).values():
+                if _hash is None:
+                    continue
+                # another link to the same inode has been hashed already
+                self._stats.count('hashes_reused')
+                self._backend.store_reference(
+                    _size, _hash, _key, file_instance.mdate(), _fingerprint,
+                    file_instance.signature())
+                return
 
+        # the file is not known yet or has been modified - register it with
+        # its fingerprint and compute full hashes only if the fingerprint is
+        # known already
+        _fingerprint = file_instance.fingerprint()
+        if _fingerprint is not None:
+            self._counters['fingerprints'] += 1
+            _peers = self._backend.fingerprint_peers(_size, _fingerprint)
+            _peers.pop(_key, None)
+            if not _peers:
+                self._counters['full_hashes_avoided'] += 1
+                self._backend.store_reference(
+                    _size, None, _key, file_instance.mdate(),
+                    _fingerprint, file_instance.signature())
+                return
+            for _other_key, (_hash, _) in _peers.items():
+                if _hash is not None:
+                    continue
+                # a file with the same fingerprint has been registered
+                # without hash so far
+                _other = file_info(
+                    self._directories.restore(_other_key),
+                    self._directories, self._hash_engine)
+                self._counters['full_hashes'] += 1
+                self._backend.set_hash(
+                    _size, _other_key, _other.content_hash())
+
+        self._counters['full_hashes'] += 1
+        self._backend.store_reference(
+            _size, file_instance.content_hash(), _key,
+            file_instance.mdate(), _fingerprint, file_instance.signature())
+
+    def _prefetch_hashes(self, file_instance, pending_files):
+        ''' predicts whether _add_file() will need the hash of <file_instance>
+            (and of the files it collides with) and lets the hash engine
+            compute them in advance. <pending_files> are files which have
+            been found but not added yet
+        '''
+        _size = file_instance.size()
+        _state = self._backend.size_state(_size)
+        if _state is None:
+            # only files waiting to be added have this size
+            _others = [(f.path(), f.inode_signature()) for f in pending_files
+                       if f.size() == _size and
+                       f.fingerprint() == file_instance.fingerprint()]
+            if not _others:
+                return
+        elif _state[0] == 'single':
+            _other = file_info(self._directories.restore(_state[1]),
+                               self._directories, self._hash_engine)
+            if (_other.path() == file_instance.path() or
+                    _other.fingerprint() != file_instance.fingerprint()):
+                return
+            _others = [(_other.path(), _other.inode_signature())]
+        elif (self._backend.entry(_size, file_instance.key())
+              is not None):
+            # file is already registered
+            return
+        elif (file_instance.inode_signature() is not None and
+              any(h is not None for h, _ in self._backend.inode_peers(
+                  file_instance.inode_signature()).values())):
+            # the hash of another link to this inode will be taken
+            return
+        elif file_instance.fingerprint() is None:
+            _others = []
         else:
-            # the current file is not contained in the respective hash file
-            # should this happen? there should be no link then
-            pass
+            _peers = self._backend.fingerprint_peers(
+                _size, file_instance.fingerprint())
+            if not _peers:
+                return
+            _others = [(self._directories.restore(p), None)
+                       for p, (h, _) in _peers.items() if h is None]
+
+        for p, _inode_signature in _others:
+            self._hash_engine.prefetch(p, _inode_signature)
+        self._hash_engine.prefetch(file_instance.path(),
+                                   file_instance.inode_signature())
+
+    def _list_directory(self, directory):
+        ''' returns a list of (path, stat_result) tuples for all regular,
+            non-empty files in <directory> and a list of its subdirectories
+            (both sorted by name). Every entry gets stat'ed at most once.
+            Might get called concurrently by walker threads
+        '''
+        _stats = self._stats
+        _start = time.perf_counter()
+        try:
+            with os.scandir(directory) as _it:
+                _entries = sorted(_it, key=lambda e: e.name)
+        except OSError as ex:
+            logging.warning('cannot list "%s": %s', directory, ex.strerror)
+            _stats.count('skipped_unlistable')
+            return [], []
+
+        _stats.add_time('walk', time.perf_counter() - _start, 'directories')
+
+        _files, _subdirs = [], []
+        _start = time.perf_counter()
+        for _entry in _entries:
+            if _entry.is_dir(follow_symlinks=False):
+                if _entry.name not in self._ignore_pattern:
+                    _subdirs.append(_entry.path)
+                else:
+                    _stats.count('skipped_ignored')
+                continue
 
-    def _walk(self, path, callback):
-        for (_dir, _dirs, files) in os.walk(path, topdown=True):
-            _dirs[:] = [d for d in _dirs if d not in self._ignore_pattern]
+            if not _entry.is_file(follow_symlinks=False):
+                # we ignore symlinks, device files, pipes, etc.
+                _stats.count('skipped_special')
+                continue
 
-            _dir = os.path.realpath(_dir)
-            for fname in files:
-                _file = file_info(path_join(_dir, fname), self._name_component_store)
-
-                if not _file.is_normal_file():
-                    # we ignore symlinks, device files, pipes, etc.
-                    continue
+            try:
+                _stat = _entry.stat(follow_symlinks=False)
+            except OSError:
+                # vanished since listing the directory
+                _stats.count('skipped_vanished')
+                continue
+
+            if _stat.st_size == 0:
+                # we even ignore empty files
+                _stats.count('skipped_empty')
+                continue
+
+            _files.append((_entry.path, _stat))
+        _stats.add_time('stat', time.perf_counter() - _start)
+        return _files, _subdirs
+
+    def _count_files(self, paths, stop):
+        ''' returns the number of files below <paths> as a cheap estimate
+            for the progress of add() - directory entries don't get stat'ed
+            so empty files get counted, too. Returns None if <stop> (a
+            threading.Event) gets set before counting has finished '''
+        _count = 0
+        _stack = list(paths)
+        while _stack:
+            if stop.is_set():
+                return None
+            try:
+                with os.scandir(_stack.pop()) as _it:
+                    for _entry in _it:
+                        if _entry.is_dir(follow_symlinks=False):
+                            if _entry.name not in self._ignore_pattern:
+                                _stack.append(_entry.path)
+                        elif _entry.is_file(follow_symlinks=False):
+                            _count += 1
+            except OSError:
+                # will be reported by the walk
+                pass
+        return _count
 
-                if _file.size() == 0:
-                    # we even ignore empty files
-                    continue
+    def _walk(self, path, callback, start_after=None):
+        ''' calls <callback> with every file yielded by _walk_files() '''
+        for _file in self._walk_files(path, start_after):
+            try:
+                callback(_file)
+            except not_indexed_error as ex:
+                ex.file_info = _file
+                raise
 
-                try:
-                    callback(_file)
-                except not_indexed_error as ex:
-                    ex.file_info = _file
-                    raise
+    def _walk_files(self, path, start_after=None, prune=None):
+        ''' yields a file_info for every regular, non-empty file below
+            <path> (depth first, sorted by name). Directories for which
+            <prune> (if given) returns True are skipped.
+            With several walkers the directories which will be visited next
+            get listed in advance on a thread pool - files are still
+            yielded in the same order.
+            With <start_after> (a file path) all files visited before it are
+            skipped - directories containing only those don't get listed
+        '''
+        _root = os.path.realpath(path)
+        _stack = [_root] if prune is None or not prune(_root) else []
+        _pending = {}
+        _resume = (None if start_after is None else
+                   walk_position(os.path.relpath(start_after, _root)))
+
+        def _dir_position(directory):
+            return tuple((1, c) for c in
+                         os.path.relpath(directory, _root).split('/')
+                         if c != '.')
+
+        while _stack:
+            if self._walk_pool is not None:
+                # keep the listings of the next directories in flight
+                for _next in reversed(_stack[-self._walk_lookahead:]):
+                    if _next not in _pending:
+                        _pending[_next] = self._walk_pool.submit(
+                            self._list_directory, _next)
+
+            _dir = _stack.pop()
+            _future = _pending.pop(_dir, None)
+            _files, _subdirs = (self._list_directory(_dir) if _future is None
+                                else _future.result())
+
+            if _resume is not None:
+                _position = _dir_position(_dir)
+                if _resume[:len(_position)] == _position:
+                    _files = [f for f in _files if _position + (
+                        (0, os.path.basename(f[0])),) > _resume]
+                    # keep subdirectories after or containing the position
+                    _subdirs = [d for d in _subdirs
+                                if _position + ((1, os.path.basename(d)),)
+                                >= _resume[:len(_position) + 1]]
+            if prune is not None:
+                _subdirs = [d for d in _subdirs if not prune(d)]
+
+            for _path, _stat in _files:
+                yield file_info(_path, self._directories,
+                                self._hash_engine, _stat)
+
+            _stack.extend(reversed(_subdirs))
 
     def _is_tracked(path: str) -> tuple:
         ''' returns a tuple containing whether or not a given path is already
@@ -507,43 +2471,151 @@ class indexer:
                 return True, p
         return False, None
 
-    def add(self, path):
-        _path = os.path.realpath(os.path.expanduser(path))
+    def _scan(self, roots):
+        ''' yields (root, file_info) for the files below all given roots
+            ([(path, start_after), ..], see _walk_files()). Roots located on
+            the same device get walked one after another, different devices
+            get walked concurrently by one thread each - the files are
+            yielded in the order they have been found '''
+        _devices = collections.OrderedDict()
+        for _root, _start_after in roots:
+            _devices.setdefault(os.stat(_root).st_dev, []).append(
+                (_root, _start_after))
+        if len(_devices) < 2:
+            for _root, _start_after in roots:
+                for _file in self._walk_files(_root, _start_after):
+                    yield _root, _file
+            return
 
-        if not os.path.exists(_path):
-            raise file_not_found_error()
+        import queue
+        _queue = queue.Queue(maxsize=1000)
+        _stop = threading.Event()
+        _done = object()
 
-        for p in self._tracked_directories:
-            if _path.startswith(p):
-                print('"%s" is already tracked via "%s"' % (path, p))
-                return
-
-        def not_contained(p1, p2):
-            if p1.startswith(p2):
-                print('Already tracked folder "%s" will be replaced' % p1)
-                return False
-            return True
-        self._tracked_directories = [
-            p for p in self._tracked_directories if not_contained(p, _path)]
+        def _put(item):
+            while not _stop.is_set():
+                try:
+                    _queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
 
-        self._tracked_directories.append(_path)
+        def _scanner(device_roots):
+            try:
+                for _root, _start_after in device_roots:
+                    for _file in self._walk_files(_root, _start_after):
+                        if not _put((_root, _file)):
+                            return
+                _put((_done, None))
+            except BaseException as ex:
+                _put((_done, ex))
+
+        _threads = [threading.Thread(target=_scanner, args=(r,), daemon=True)
+                    for r in _devices.values()]
+        for _thread in _threads:
+            _thread.start()
+        try:
+            _running = len(_threads)
+            while _running:
+                _root, _item = _queue.get()
+                if _root is _done:
+                    _running -= 1
+                    if _item is not None:
+                        raise _item
+                    continue
+                yield _root, _item
+        finally:
+            _stop.set()
+            for _thread in _threads:
+                _thread.join()
+
+    def add(self, path, progress=None, resume=False, checkpoint_interval=10,
+            precount=False):
+        ''' indexes all files below <path> - see add_paths() '''
+        return self.add_paths([path], progress, resume, checkpoint_interval,
+                              precount)
+
+    @_with_add_lock
+    def add_paths(self, paths, progress=None, resume=False,
+                  checkpoint_interval=10, precount=False,
+                  remove_vanished=False):
+        ''' indexes all files below <paths> - paths located on different
+            devices get walked concurrently. <progress> can be a
+            progress_reporter instance. Every <checkpoint_interval> seconds
+            the changes get committed together with the current positions
+            so an interrupted run can be continued with <resume> set.
+            With <precount> the files get counted in the background first
+            so <progress> can give an ETA for folders not indexed before.
+            With <remove_vanished> entries of files below <paths> which
+            the walk didn't come across and which don't exist anymore get
+            removed '''
+        _paths = []
+        for path in paths:
+            _path = os.path.realpath(os.path.expanduser(path))
+            if not os.path.exists(_path):
+                raise file_not_found_error()
+            _paths.append(_path)
+
+        for _path in _paths:
+            self._track(_path)
 
         _result = {"file_count": 0,
-                   "total_size": 0}
-
-        def file_adder(file_instance, stats):
+                   "total_size": 0,
+                   "unchanged": 0}
+        self._counters.clear()
+
+        _interrupted = self._journal_positions() if resume else {}
+        _positions = {}
+        for _path in _paths:
+            _positions[_path] = _interrupted.get(_path)
+            if _path in _interrupted:
+                logging.info('resume after "%s"', _positions[_path] or _path)
+            elif resume:
+                logging.warning('nothing to resume for "%s"', _path)
+        _journal = {'positions': _positions, 'pid': os.getpid()}
+        self._store_hash_algorithm()
+        self._checkpoint(_journal)
+        _next_checkpoint = time.monotonic() + checkpoint_interval
+
+        # signatures of all files which have been indexed before - files
+        # which still have the same signature don't have to be looked at
+        _known_signatures = {}
+        for _path in _paths:
+            _known_signatures.update(self._backend.signatures(
+                *self._directories.interval(self._directories.node(_path))))
+
+        def file_adder(root, file_instance, stats):
+            nonlocal _next_checkpoint
+            _t = time.time()
             try:
-                _t = time.time()
-                self._add_file(file_instance)
+                if (_known_signatures.pop(file_instance.key(), None)
+                        == file_instance.signature()):
+                    stats['unchanged'] += 1
+                    self._stats.count('skipped_unchanged')
+                else:
+                    self._add_file(file_instance)
                 _t = time.time() - _t
                 stats['total_size'] += file_instance.size()
             except read_permission_error:
                 logging.warning('cannot handle "%s": read permission denied',
                                 file_instance.path())
+                self._stats.count('skipped_permission')
+            except file_not_found_error:
+                logging.warning('cannot handle "%s": file has vanished',
+                                file_instance.path())
+                self._stats.count('skipped_vanished')
             except KeyboardInterrupt:
                 raise
 
             stats['file_count'] += 1
+            self._stats.count('files')
+            _positions[root] = file_instance.path()
+            if time.monotonic() >= _next_checkpoint:
+                self._checkpoint(_journal)
+                _next_checkpoint = time.monotonic() + checkpoint_interval
+            if progress is not None:
+                progress.update(stats['file_count'], stats['total_size'])
 
             if file_instance.size() >= 10 ** 6:
                 logging.debug("%s: %s bytes, %.1fms, %.2fMb/ms",
@@ -551,14 +2623,487 @@ class indexer:
                               '{0:,}'.format(file_instance.size()), _t * 1000,
                               file_instance.size() / (2 << 20) / (_t  * 1000))
 
-        self._walk(_path, lambda x: file_adder(x, _result))
-
-        logging.info("added %d files with a total of %s bytes",
+        if progress is not None:
+            # files indexed before are a cheap estimate of what's to come
+            progress.start(len(_known_signatures),
+                           sum(s[0] for s in _known_signatures.values()),
+                           self._stats)
+
+        # with several hash jobs files get added with a delay of a few files
+        # so the hashes they will need can be computed in advance
+        _window = collections.deque()
+        _window_size = 8 * self._hash_engine.jobs()
+
+        _stop_counting = threading.Event()
+        if progress is not None and precount:
+            threading.Thread(
+                target=lambda: progress.expect_files(
+                    self._count_files(_paths, _stop_counting)),
+                name='fsi-count', daemon=True).start()
+
+        _files = self._scan(list(_positions.items()))
+        # closing() stops the scanning threads if adding fails
+        with contextlib.closing(_files):
+            try:
+                if self._hash_engine.jobs() > 1:
+                    for _root, _file in _files:
+                        try:
+                            if (_known_signatures.get(_file.key())
+                                    != _file.signature()):
+                                self._prefetch_hashes(
+                                    _file, [f for _, f in _window])
+                        except (file_not_found_error, read_permission_error):
+                            # will be reported when the file gets added
+                            pass
+                        _window.append((_root, _file))
+                        if len(_window) > _window_size:
+                            file_adder(*_window.popleft(), _result)
+                    while _window:
+                        file_adder(*_window.popleft(), _result)
+                else:
+                    for _root, _file in _files:
+                        file_adder(_root, _file, _result)
+            finally:
+                _stop_counting.set()
+        self._hash_engine.clear()
+        if remove_vanished and not resume:
+            # files indexed before which haven't been visited
+            _vanished = [(k, s[0]) for k, s in _known_signatures.items()
+                         if not self._is_current(k, s[0], s[1])]
+            self._backend.remove_references(k for k, _ in _vanished)
+            self._backend.collapse_sizes(sorted({s for _, s in _vanished}))
+            _result['removed'] = len(_vanished)
+            logging.info('removed %d vanished files', len(_vanished))
+        self._update_directory_digests()
+        self._checkpoint(None)
+
+        if progress is not None:
+            progress.finish(_result['file_count'], _result['total_size'])
+
+        logging.info("added %d files with a total of %s bytes "
+                     "(%d unchanged)",
                      _result['file_count'],
-                     '{0:,}'.format(_result['total_size']))
+                     '{0:,}'.format(_result['total_size']),
+                     _result['unchanged'])
+        _result.update(
+            (k, self._counters[k])
+            for k in ('fingerprints', 'full_hashes', 'full_hashes_avoided'))
+        logging.info("computed %d fingerprints and %d full hashes, "
+                     "%d full hashes avoided",
+                     _result['fingerprints'], _result['full_hashes'],
+                     _result['full_hashes_avoided'])
         return _result
 
-    def diff(self, dir1, dir2):
+    def _track(self, path):
+        ''' adds <path> to the tracked directories - unless it's located
+            below one of them. Tracked directories below it get replaced '''
+        for p in self._tracked_directories:
+            if path.startswith(p):
+                logging.info('"%s" is already tracked via "%s" - update',
+                             path, p)
+                return
+
+        def not_contained(p1, p2):
+            if p1.startswith(p2):
+                print('Already tracked folder "%s" will be replaced' % p1)
+                return False
+            return True
+        self._tracked_directories = [
+            p for p in self._tracked_directories
+            if not_contained(p, path)]
+
+        self._tracked_directories.append(path)
+
+    def _update_file(self, path):
+        ''' brings the index entry for file <path> up to date - i.e. adds,
+            updates or removes it '''
+        _file = file_info(path, self._directories, self._hash_engine)
+        try:
+            _stat = _file.stat()
+        except fsi_error:
+            _stat = None
+        if (_stat is not None and stat.S_ISREG(_stat.st_mode) and
+                _stat.st_size > 0):
+            try:
+                self._add_file(_file)
+            except (file_not_found_error, read_permission_error):
+                pass
+            return
+        try:
+            _key = self._directories.key(path, const=True)
+        except not_indexed_error:
+            return
+        self._backend.remove_references((_key,))
+
+    def _remove_directory(self, directory):
+        ''' removes all entries below <directory> from the index '''
+        try:
+            _node = self._directories.node(directory, const=True)
+        except not_indexed_error:
+            return
+        self._backend.remove_references(
+            e[0] for e in self._backend.files_below(
+                *self._directories.interval(_node)))
+
+    def _is_current(self, key, size, mtime_ns):
+        ''' False if the file an index entry refers to has vanished or has
+            been changed since it has been indexed '''
+        try:
+            _stat = os.lstat(self._directories.restore(key))
+        except FileNotFoundError:
+            return False
+        except NotADirectoryError:
+            return False
+        except OSError:
+            # e.g. no permission - there might still be a file
+            return True
+        return (stat.S_ISREG(_stat.st_mode) and _stat.st_size == size and
+                mtime_ns in (None, _stat.st_mtime_ns))
+
+    @_with_add_lock
+    def gc(self, budget=None, batch_size=1000):
+        ''' removes the entries of files which have vanished or changed since
+            they have been indexed (they'd have to be added again anyway),
+            turns sizes with only one file left into single entries again
+            and - after a complete run - removes directories without files
+            and compacts the index. With <budget> (seconds) it stops after
+            that time - the next call continues where it stopped.
+            Returns a dict of counters '''
+        _deadline = None if budget is None else time.monotonic() + budget
+        _result = {'checked': 0, 'removed': 0, 'collapsed': 0,
+                   'directories_removed': 0, 'complete': False,
+                   'bytes_before': self._backend.storage_size()}
+        _cursor = self._backend.get_meta('gc_cursor')
+        _cursor = None if _cursor is None else tuple(json.loads(_cursor))
+        _sizes = set()
+        while True:
+            _entries = self._backend.entries_after(_cursor, batch_size)
+            if not _entries:
+                _result['complete'] = True
+                break
+            _dead = [(k, s) for k, s, m in _entries
+                     if not self._is_current(k, s, m)]
+            self._backend.remove_references(k for k, _ in _dead)
+            _sizes.update(s for _, s in _dead)
+            _result['checked'] += len(_entries)
+            _result['removed'] += len(_dead)
+            _cursor = _entries[-1][0]
+            if len(_entries) < batch_size:
+                _result['complete'] = True
+                break
+            if _deadline is not None and time.monotonic() >= _deadline:
+                break
+        _result['collapsed'] = self._backend.collapse_sizes(sorted(_sizes))
+
+        if _result['complete']:
+            _table = self._directories
+            _used = set()
+            for _node in self._backend.used_directories():
+                while _node in _table and _node not in _used:
+                    _used.add(_node)
+                    _node = _table.parent(_node)
+            _unused = [n[0] for n in self._backend.nodes()
+                       if n[0] not in _used and n[0] != _table.ROOT]
+            self._backend.remove_nodes(_unused)
+            _result['directories_removed'] = len(_unused)
+            self._directory_table = None
+            self._tracked_directories = [
+                p for p in self._tracked_directories if os.path.isdir(p)]
+        self._backend.set_meta(
+            'gc_cursor', None if _result['complete'] else json.dumps(_cursor))
+        self._update_directory_digests()
+        self._backend.commit()
+        if _result['complete'] and (
+                _result['removed'] or _result['directories_removed']):
+            self._backend.compact()
+        _result['bytes_after'] = self._backend.storage_size()
+        return _result
+
+    def _watch_tree(self, watcher, directory):
+        ''' adds watches for <directory> and all directories below '''
+        _stack = [directory]
+        while _stack:
+            _dir = _stack.pop()
+            if watcher.add_watch(_dir):
+                _stack.extend(self._list_directory(_dir)[1])
+
+    @_with_add_lock
+    def _apply_events(self, watcher, events):
+        ''' updates the index according to a batch of (coalesced) inotify
+            events - returns the number of files and directories handled '''
+        _files, _new_dirs, _gone_dirs = set(), set(), set()
+        for _path, _mask in events:
+            if _path is None:
+                # the kernel dropped events - we don't know what changed
+                logging.warning('inotify queue overflow - rescan %s',
+                                ', '.join(self._tracked_directories))
+                for _dir in self._tracked_directories:
+                    self._watch_tree(watcher, _dir)
+                    self.add_paths([_dir], remove_vanished=True)
+                self._checkpoint(None)
+                return len(self._tracked_directories)
+            if any(c in self._ignore_pattern for c in _path.split('/')):
+                continue
+            if not _mask & watcher.IN_ISDIR:
+                _files.add(_path)
+            elif _mask & (watcher.IN_CREATE | watcher.IN_MOVED_TO):
+                _new_dirs.add(_path)
+                _gone_dirs.discard(_path)
+            elif _mask & (watcher.IN_DELETE | watcher.IN_MOVED_FROM):
+                _gone_dirs.add(_path)
+                _new_dirs.discard(_path)
+
+        for _dir in sorted(_gone_dirs):
+            logging.info('removed: %s', _dir)
+            self._remove_directory(_dir)
+        for _dir in sorted(_new_dirs):
+            if os.path.isdir(_dir):
+                logging.info('rescan: %s', _dir)
+                self._watch_tree(watcher, _dir)
+                self.add(_dir)
+        for _path in sorted(_files):
+            logging.debug('update: %s', _path)
+            self._update_file(_path)
+        self._update_directory_digests()
+        self._checkpoint(None)
+        return len(_files) + len(_new_dirs) + len(_gone_dirs)
+
+    def watch(self, coalesce=1.0, stop=None):
+        ''' keeps the index of all tracked directories up to date using
+            inotify until <stop> (a threading.Event) gets set. Events get
+            collected until there has been no new one for <coalesce>
+            seconds (but not longer than 10 * <coalesce>) '''
+        with inotify_watcher() as _watcher:
+            for _dir in self._tracked_directories:
+                self._watch_tree(_watcher, _dir)
+            logging.info('watching %d directories', len(_watcher))
+            while stop is None or not stop.is_set():
+                _events = _watcher.read_events(timeout=1.0)
+                _deadline = time.monotonic() + 10 * coalesce
+                while _events and time.monotonic() < _deadline:
+                    _more = _watcher.read_events(timeout=coalesce)
+                    if not _more:
+                        break
+                    _events.extend(_more)
+                if _events:
+                    self._apply_events(_watcher, _events)
+
+    def is_backed_up(self, path, verify=False):
+        ''' returns the paths of all indexed copies of file <path> - raises
+            not_indexed_error if it has not been indexed or changed since.
+            With <verify> set only copies which are unchanged on disk count
+        '''
+        _file = file_info(os.path.realpath(path))
+        try:
+            _key = self._directories.key(_file.path(), const=True)
+            _entry = self._backend.entry(_file.size(), _key)
+        except (not_indexed_error, file_not_found_error):
+            raise not_indexed_error(_file)
+        if _entry is None or _entry[2] not in (None, _file.mdate()):
+            raise not_indexed_error(_file)
+        if _entry[0] is None:
+            return []
+        _copies = []
+        for _other_key, _mdate in self._backend.references(
+                _file.size(), _entry[0]).items():
+            if _other_key == _key:
+                continue
+            _copy = file_info(self._directories.restore(_other_key))
+            if verify and not (_copy.is_normal_file() and
+                               _copy.mdate() == _mdate):
+                continue
+            _copies.append(_copy.path())
+        return sorted(_copies)
+
+    def _answer(self, line):
+        ''' runs a query received by serve() and returns the response '''
+        try:
+            self.refresh()
+            _output = io.StringIO()
+            with contextlib.redirect_stdout(_output):
+                run_query(self, json.loads(line))
+            return {'output': _output.getvalue()}
+        except not_indexed_error as ex:
+            return {'error': 'not_indexed', 'path': ex.path()}
+        except Exception as ex:
+            # every query gets an answer - the client would wait otherwise
+            if not isinstance(ex, fsi_error):
+                logging.exception('query failed: %s', line.strip())
+            return {'error': 'failed',
+                    'message': getattr(ex, 'message', None) or repr(ex)}
+        finally:
+            # queries must not write - another process might be adding
+            self._backend.rollback()
+
+    def serve(self, socket_path, stop=None, ready=None):
+        ''' answers queries (see run_query()) sent as JSON lines to the Unix
+            socket <socket_path> until <stop> (a threading.Event) gets set.
+            <ready> gets set as soon as the socket accepts connections '''
+        import socketserver
+        _indexer = self
+
+        class _handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for _line in self.rfile:
+                    self.wfile.write(
+                        json.dumps(_indexer._answer(_line)).encode() + b'\n')
+
+        if os.path.exists(socket_path):
+            if query_daemon(socket_path, {'command': 'ping'}) is not None:
+                raise daemon_error('already running on %s' % socket_path)
+            os.remove(socket_path)
+        with socketserver.UnixStreamServer(socket_path, _handler) as _server:
+            _server.timeout = 0.5
+            logging.info('serving on %s', socket_path)
+            if ready is not None:
+                ready.set()
+            try:
+                while stop is None or not stop.is_set():
+                    _server.handle_request()
+            finally:
+                os.remove(socket_path)
+
+    def _update_directory_digests(self):
+        ''' recomputes the digests of all directories whose files have
+            changed and of their parents. A directory's digest is computed
+            from the sizes and hashes of its files and the digests of its
+            subdirectories - together with their names or (unnamed digest)
+            without. Directories containing a file without hash (i.e. a
+            file without copy) get no digest - they can't have a twin.
+            Directories without files get an empty one '''
+        _stale = self._backend.stale_nodes()
+        if not _stale:
+            return
+        _table = self._directories
+        _nodes = set()
+        for _node in _stale:
+            while _node in _table and _node not in _nodes:
+                _nodes.add(_node)
+                _node = _table.parent(_node)
+        # removed directories only have to be unmarked
+        self._backend.store_digests(
+            (None, None, n) for n in _stale if n not in _table)
+
+        _algorithm = HASH_ALGORITHMS[self._hash_engine.algorithm()]
+
+        def _digest(lines):
+            return _algorithm('\n'.join(sorted(lines)).encode()).hexdigest()
+
+        # subdirectories first - they have higher pre order numbers
+        for _node in sorted(_nodes, key=lambda n: _table.interval(n)[0],
+                            reverse=True):
+            _files = self._backend.files_in(_node)
+            # directories without files (anymore) don't count
+            _subdirs = [d for d in self._backend.subdirectories(_node)
+                        if d[2] != '']
+            if not _files and not _subdirs:
+                self._backend.store_digests((('', '', _node),))
+            elif (any(f[2] is None for f in _files) or
+                  any(d[2] is None for d in _subdirs)):
+                self._backend.store_digests(((None, None, _node),))
+            else:
+                self._backend.store_digests(((
+                    _digest(['%d f %d %s' % f[:3] for f in _files] +
+                            ['%d d %s' % d[1:3] for d in _subdirs]),
+                    _digest(['f %d %s' % f[1:3] for f in _files] +
+                            ['d %s' % d[3] for d in _subdirs]),
+                    _node),))
+
+    def duplicate_directories(self, directory=None, ignore_names=False):
+        ''' returns a list of groups (lists of paths) of directories with
+            identical content - with <ignore_names> set file and directory
+            names are not taken into account. Groups which are only implied
+            by identical parent directories are left out. With <directory>
+            given only groups with a member below it are returned '''
+        self._update_directory_digests()
+        _groups = self._backend.duplicate_nodes(ignore_names)
+        _digests = {n: d for d, _nodes in _groups.items() for n in _nodes}
+        _below = (None if directory is None else self._directories.node(
+            os.path.realpath(directory), const=True))
+        _result = []
+        for _nodes in _groups.values():
+            _parents = {self._directories.parent(n) for n in _nodes}
+            if (len(_parents) == len(_nodes) and
+                    len({_digests.get(p) for p in _parents}) == 1 and
+                    next(iter(_parents)) in _digests):
+                # the parents are identical already
+                continue
+            if _below is not None and not any(
+                    self._directories.is_below(n, _below) for n in _nodes):
+                continue
+            _result.append(sorted(self._directories.dir_path(n)
+                                  for n in _nodes))
+        return sorted(_result)
+
+    def _indexed_contents(self, directory):
+        ''' returns a dict {content: [(key, mtime_ns), ..]} of all indexed
+            files below <directory> read from the index in one query.
+            Files with equal <content> are equal: it consists of the size
+            and the hash - or the fingerprint for files without hash, which
+            is unique for this size then (otherwise they'd have a hash) '''
+        _result = collections.defaultdict(list)
+        for _key, _size, _hash, _fingerprint, _mtime_ns in (
+                self._backend.files_below(*self._directories.interval(
+                    self._directories.node(directory, const=True)))):
+            _result[(_size, _hash, None if _hash else _fingerprint)].append(
+                (_key, _mtime_ns))
+        return _result
+
+    def _verified_file(self, key, mtime_ns):
+        ''' returns a file_info instance for an index entry or None if the
+            file doesn't exist anymore '''
+        _file = file_info(self._directories.restore(key))
+        if not _file.is_normal_file():
+            logging.warning('indexed file vanished: %s', _file.path())
+            return None
+        if mtime_ns is not None and _file.signature()[1] != mtime_ns:
+            logging.warning(
+                'file might have been modified since indexed: %s',
+                _file.path())
+        return _file
+
+    def _verified(self, entries):
+        ''' returns file_info instances for index entries [(key, mtime_ns),
+            ..] which still exist on the filesystem '''
+        return sorted((f for f in (self._verified_file(*e) for e in entries)
+                       if f is not None), key=file_info.path)
+
+    def _lacks_copy_in(self, file_instance, other_dir):
+        ''' returns True if the indexed duplicates of <file_instance> exist
+            but none of them is located below node <other_dir> '''
+        _registered, _, _duplicates = self._get_state(file_instance)
+        if not _registered:
+            raise not_indexed_error(file_instance)
+        if len(_duplicates) == 0:
+            logging.warning('single: %s', file_instance.path())
+            return False
+        # the file has at least one duplicate - we now have to check
+        # if at least one of them is located in `other_dir`
+        for f, d in _duplicates.items():
+            if not self._directories.is_below(f[0], other_dir):
+                continue
+            _file = file_info(self._directories.restore(f))
+
+            if not _file.is_normal_file():
+                logging.warning(
+                    'possible duplicate invalid: %s', _file.path())
+                continue
+            if not _file.mdate() == d:
+                logging.warning(
+                    'possible duplicate might have been modified: %s',
+                    _file.path())
+                continue
+            return False
+        return True
+
+    def iter_diff(self, dir1, dir2, from_index=False):
+        ''' yields (directory, file_info) for every file which exists only
+            in <directory> (<dir1> or <dir2> with symlinks resolved) - those
+            only in <dir1> first. Files are yielded as soon as they have
+            been checked (with <from_index> set one directory at a time).
+            Subdirectories with the same (unnamed) digest as a directory on
+            the other side are not walked - the index says their files have
+            copies there '''
         _dir1 = os.path.realpath(dir1)
         _dir2 = os.path.realpath(dir2)
         assert os.path.isdir(_dir1)
@@ -568,123 +3113,262 @@ class indexer:
         assert (not (_dir1.startswith(_dir2) or _dir2.startswith(_dir1))
                 ), "directories must not be subdirectories of each other"
 
-        def _dir_differ(file_instance, other_dir, result):
-            _registered, _, _duplicates = self._get_state(file_instance)
-            if not _registered:
-                raise not_indexed_error(file_instance)
-            elif len(_duplicates) == 0:
-                logging.warning('single: %s', file_instance.path())
-            else:
-                # the file has at least one duplicate - we now have to check
-                # if at least one of them is located in `other_dir`
-                _file_in_other_dir = False
-                for f, d in _duplicates.items():
-                    if not f.startswith(other_dir):
-                        continue
-                    _file = file_info(self._name_component_store.restore(f))
-
-                    if not _file.is_normal_file():
-                        logging.warning(
-                            'possible duplicate invalid: %s', _file.path())
-                        continue
-                    if not _file.mdate() == d:
-                        logging.warning(
-                            'possible duplicate might have been modified: %s',
-                            _file.path())
-                        continue
-                    _file_in_other_dir = True
-                    break
-
-                if not _file_in_other_dir:
-                    result.append(file_instance)
+        if from_index:
+            _contents1 = self._indexed_contents(_dir1)
+            _contents2 = self._indexed_contents(_dir2)
+            for _dir, _own, _other in ((_dir1, _contents1, _contents2),
+                                       (_dir2, _contents2, _contents1)):
+                for _file in self._verified(
+                        e for c in _own.keys() - _other.keys()
+                        for e in _own[c]):
+                    yield _dir, _file
+            return
 
+        _node1 = self._directories.node(_dir1, const=True)
+        _node2 = self._directories.node(_dir2, const=True)
+        self._update_directory_digests()
+        _interval1 = self._directories.interval(_node1)
+        _interval2 = self._directories.interval(_node2)
+        _equal = (self._backend.equal_nodes(*_interval1 + _interval2) |
+                  self._backend.equal_nodes(*_interval2 + _interval1))
+
+        def _prune(directory):
+            try:
+                return self._directories.node(directory, const=True) in _equal
+            except not_indexed_error:
+                return False
+
+        for _dir, _other in ((_dir1, _node2), (_dir2, _node1)):
+            for _file in self._walk_files(_dir, prune=_prune):
+                if self._lacks_copy_in(_file, _other):
+                    yield _dir, _file
+
+    def diff(self, dir1, dir2, from_index=False):
+        _dir1 = os.path.realpath(dir1)
+        _dir2 = os.path.realpath(dir2)
         _not_in_1 = []
         _not_in_2 = []
+        for _dir, _file in self.iter_diff(_dir1, _dir2, from_index):
+            (_not_in_2 if _dir == _dir1 else _not_in_1).append(_file)
 
-        self._walk(_dir1, lambda _file: _dir_differ(
-            _file,
-            self._name_component_store.get_packed(_dir2, const=True) + '.',
-            _not_in_2))
+        self._print_diff(_dir1, _dir2, _not_in_1, _not_in_2)
+        return _not_in_1, _not_in_2
 
-        self._walk(_dir2, lambda _file: _dir_differ(
-            _file,
-            self._name_component_store.get_packed(_dir1, const=True) + '.',
-            _not_in_1))
-
-        if len(_not_in_2) > 0:
-            print('only in "%s":' % _dir1)
-            for d in _not_in_2:
+    @staticmethod
+    def _print_diff(dir1, dir2, not_in_1, not_in_2):
+        if len(not_in_2) > 0:
+            print('only in "%s":' % dir1)
+            for d in not_in_2:
                 print("    %s" % d.path())
-        if len(_not_in_1) > 0:
-            print('only in "%s":' % _dir2)
-            for d in _not_in_1:
+        if len(not_in_1) > 0:
+            print('only in "%s":' % dir2)
+            for d in not_in_1:
                 print("    %s" % d.path())
 
-    def check_redundancy(self, directory, invert=False):
+    def _redundancy_from_index(self, directory, invert, verify):
+        ''' like _redundancy() but answered by two range queries on the
+            index - with <verify> set the files and their copies get checked
+            on the filesystem. Files are yielded in index order '''
+        _interval = self._directories.interval(
+            self._directories.node(directory, const=True))
+        _copies = collections.defaultdict(lambda: ([], []))
+        for _key, _other_key, _mtime_ns, _same_inode in (
+                self._backend.copies_outside(*_interval)):
+            if not verify or self._verified_file(_other_key, _mtime_ns):
+                _copies[_key][_same_inode].append(_other_key)
+
+        for _key, _, _, _, _mtime_ns in self._backend.files_below(*_interval):
+            if invert == (_key in _copies):
+                continue
+            _file = (self._verified_file(_key, _mtime_ns) if verify else
+                     file_info(self._directories.restore(_key)))
+            if _file is None:
+                continue
+            if invert:
+                yield _file, None, None
+            else:
+                yield _file, sorted(_copies[_key][0]), sorted(_copies[_key][1])
+
+    def _redundancy(self, directory, invert, from_index, verify):
+        ''' yields (file_info, [keys of copies outside <directory>], [keys of
+            hardlinks outside <directory>]) for every file below <directory>
+            which has copies elsewhere - or (file_info, None, None) for every
+            file which has none if <invert> is set (the file might still be
+            duplicate inside <directory>) '''
         _dir = os.path.realpath(directory)
         assert os.path.isdir(_dir)
 
-        def _dup_finder(file_instance, packed_dir, invert, result):
-            ''' will check file_instance for duplicates _outside_ of
-                <packed_dir> if <invert> is False <result> will contain the
-                list of files which have copies outside <packed_dir>
-                if <invert> is True, <result> will contain the list of files
-                which are only located in <packed_dir> (where it might be
-                duplicate)
-            '''
-            _registered, _, _duplicates = self._get_state(file_instance)
-            if not _registered:
-                raise not_indexed_error(file_instance)
-            _found = False
-            for p in _duplicates:
-                if p.startswith(packed_dir):
-                    # we found a duplicate of <file_instance> which is
-                    # located inside of <packed_path>
-                    continue
-                _found = True
-                if not invert:
-                    # we found a duplicate outside given direcory.
-                    # in case we do an non-inverted search we now know
-                    # this file is duplicated and can be added to the result
-                    if not file_instance in result:
-                        result[file_instance] = []
-                    result[file_instance].append(p)
-                else:
-                    break
-
-            if invert:
-                if not _found:
-                    result[file_instance] = None
-
+        if from_index:
+            yield from self._redundancy_from_index(_dir, invert, verify)
             return
 
-        _result = {}
-        self._walk(_dir, lambda _file: _dup_finder(
-            _file,
-            self._name_component_store.get_packed(_dir, const=True) + '.',
-            invert,
-            _result))
-
+        _node = self._directories.node(_dir, const=True)
+        for _file in self._walk_files(_dir):
+            _registered, _, _duplicates = self._get_state(_file)
+            if not _registered:
+                raise not_indexed_error(_file)
+            _outside = [p for p in _duplicates
+                        if not self._directories.is_below(p[0], _node)]
+            if invert:
+                if not _outside:
+                    yield _file, None, None
+            elif _outside:
+                _inode_signature = _file.inode_signature()
+                _links = (() if _inode_signature is None else
+                          self._backend.inode_peers(_inode_signature))
+                yield (_file, [p for p in _outside if p not in _links],
+                       [p for p in _outside if p in _links])
+
+    def iter_redundancy(self, directory, invert=False, from_index=False,
+                        verify=False):
+        ''' yields (file_info, [paths of copies], [paths of hardlinks]) like
+            check_redundancy() finds them, i.e. without collecting or
+            sorting the result '''
+        for _file, _copies, _links in self._redundancy(
+                directory, invert, from_index, verify):
+            if _copies is None:
+                yield _file, None, None
+                continue
+            yield (_file, [self._directories.restore(c) for c in _copies],
+                   [self._directories.restore(c) for c in _links])
+
+    def check_redundancy(self, directory, invert=False, from_index=False,
+                         verify=False):
+        ''' returns a dict {file_info: [keys of copies and hardlinks outside
+            <directory>]} - or {file_info: None} for the files without copy
+            outside with <invert> set - and prints it '''
+        _found = list(self._redundancy(directory, invert, from_index, verify))
+        if from_index:
+            _found.sort(key=lambda r: r[0].path())
+
+        self._print_redundancy(_found, invert)
+        return {f: None if invert else c + l for f, c, l in _found}
+
+    def _print_redundancy(self, result, invert):
         if invert:
             # we checked for redundancy for all files
-            if len(_result) == 0:
+            if len(result) == 0:
                 print('all files redundant')
             else:
-                for p in _result:
+                for p, _, _ in result:
                     print(p.path())
                 print('.. without copy')
         else:
             # we searched for files with redundand copyies
-            if len(_result) == 0:
+            if len(result) == 0:
                 print('directory is free of redundancy')
             else:
-                for p in _result:
+                for p, _copies, _links in result:
                     print(p.path())
-                    for c in _result[p]:
-                        print("   " + self._name_component_store.restore(c))
+                    for c in _copies:
+                        print("   " + self._directories.restore(c))
+                    for c in _links:
+                        print("   %s (same inode)" %
+                              self._directories.restore(c))
                 print('.. are redundant')
 
 
+QUERY_COMMANDS = ('check-dups', 'check-redundancy', 'diff', 'is-backed-up',
+                  'dup-dirs')
+
+
+def run_query(indexer_instance, request):
+    ''' runs a read only command given as dict {"command": .., "paths": [..],
+        "invert": .., "from_index": .., "verify": .., "ignore_names": ..,
+        "format": ..} and prints
+        its result. With format "jsonl" every result is printed as a JSON
+        object on its own line as soon as it has been found.
+        Used by the CLI and by `fsi serve` alike '''
+    _command = request['command']
+    _paths = request.get('paths', [])
+    _options = {'from_index': request.get('from_index', False),
+                'verify': request.get('verify', False)}
+    _jsonl = request.get('format', 'text') == 'jsonl'
+
+    def _emit(record):
+        print(json.dumps(record), flush=True)
+
+    if _command == 'ping':
+        pass
+    elif _command in ('check-dups', 'check-redundancy'):
+        _invert = _command == 'check-redundancy' or request.get('invert', False)
+        for d in _paths:
+            logging.info("check four duplicates in '%s'", d)
+            if not _jsonl:
+                indexer_instance.check_redundancy(d, invert=_invert, **_options)
+                continue
+            for _file, _copies, _links in indexer_instance.iter_redundancy(
+                    d, invert=_invert, **_options):
+                _record = {'path': _file.path()}
+                if _copies is not None:
+                    _record.update(copies=_copies, same_inode=_links)
+                _emit(_record)
+    elif _command == 'diff':
+        logging.info("DIFF directories '%s' and '%s'", _paths[0], _paths[1])
+        if not _jsonl:
+            indexer_instance.diff(_paths[0], _paths[1],
+                                  from_index=_options['from_index'])
+        else:
+            for _dir, _file in indexer_instance.iter_diff(
+                    _paths[0], _paths[1], from_index=_options['from_index']):
+                _emit({'only_in': _dir, 'path': _file.path()})
+    elif _command == 'dup-dirs':
+        for d in _paths or [None]:
+            for _group in indexer_instance.duplicate_directories(
+                    d, ignore_names=request.get('ignore_names', False)):
+                if _jsonl:
+                    _emit({'directories': _group})
+                    continue
+                for _path in _group:
+                    print(_path)
+                print()
+    elif _command == 'is-backed-up':
+        for p in _paths:
+            _copies = indexer_instance.is_backed_up(
+                p, verify=_options['verify'])
+            if _jsonl:
+                _emit({'path': p, 'copies': _copies})
+                continue
+            print('%s: %s' % (p, '%d copies' % len(_copies) if _copies
+                              else 'no copy'))
+            for c in _copies:
+                print('   ' + c)
+    else:
+        raise daemon_error('unknown command "%s"' % _command)
+
+
+def daemon_socket(storage_dir):
+    return os.path.join(os.path.expanduser(storage_dir), 'fsi.sock')
+
+
+def query_daemon(socket_path, request):
+    ''' sends <request> to a running `fsi serve` and returns the output of
+        the query - or None if there is no daemon listening on
+        <socket_path> '''
+    if not os.path.exists(socket_path):
+        return None
+    import socket
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as _socket:
+        try:
+            _socket.connect(socket_path)
+        except OSError:
+            # left behind by a daemon which has been killed
+            return None
+        _socket.sendall(json.dumps(request).encode() + b'\n')
+        _socket.shutdown(socket.SHUT_WR)
+        with _socket.makefile('rb') as _response:
+            _line = _response.readline()
+    if not _line:
+        # the daemon went away while answering
+        raise daemon_error('no response')
+    _answer = json.loads(_line)
+    if _answer.get('error') == 'not_indexed':
+        raise not_indexed_error(path=_answer['path'])
+    if 'error' in _answer:
+        raise daemon_error(_answer.get('message', _answer['error']))
+    return _answer['output']
+
+
 def clear_index(storage_dir: str) -> None:
     # todo: to be atomic, first move directory, then delete it
     print('removing %s..' % storage_dir)
@@ -693,17 +3377,62 @@ def clear_index(storage_dir: str) -> None:
 
 
 def main():
+    import argparse
     parser = argparse.ArgumentParser(description='Process some integers.')
     parser.add_argument('--verbose', '-v',     action='count', default = 0)
     parser.add_argument('--debug', '-d',       action='store_true')
     parser.add_argument('--const', '-c',       action='store_true')
     parser.add_argument('--rebuild', '-r',     action='store_true')
     parser.add_argument('--invert', '-i',      action='store_true')
+    parser.add_argument('--from-index',        action='store_true',
+                        help='answer from the index without traversing the '
+                             'directories')
+    parser.add_argument('--verify',            action='store_true',
+                        help='with --from-index: check the resulting files '
+                             'on disk')
     parser.add_argument('--storage-dir', '-s', default='~/.fsi')
+    parser.add_argument('--backend', '-b',     default='sqlite',
+                        choices=sorted(index_backends))
+    parser.add_argument('--jobs', '-j',        type=int, default=1)
+    parser.add_argument('--walkers', '-w',     type=int, default=1)
+    parser.add_argument('--hash',              choices=sorted(HASH_ALGORITHMS),
+                        help='content hash algorithm of a new index')
+    parser.add_argument('--write-buffer',      type=int, default=10000,
+                        help='number of index changes collected in memory '
+                             'before they get written (0 disables)')
+    parser.add_argument('--flush-interval',    type=float, default=5.0,
+                        help='seconds after which collected index changes '
+                             'get written')
+    parser.add_argument('--time-budget',       type=float, metavar='SECONDS',
+                        help='gc: stop after SECONDS, the next run '
+                             'continues')
+    parser.add_argument('--ignore-names',      action='store_true',
+                        help='dup-dirs: compare directories by content only')
+    parser.add_argument('--format',            choices=('text', 'jsonl'),
+                        default='text',
+                        help='print query results as text or stream them '
+                             'as one JSON object per line')
+    parser.add_argument('--no-daemon',         action='store_true',
+                        help="don't ask a running `fsi serve`")
+    parser.add_argument('--resume',            action='store_true',
+                        help='continue an interrupted `add` (of PATH)')
+    parser.add_argument('--progress',          action='store_true',
+                        help='report the progress of `add` on stderr (as '
+                             'JSON lines if stderr is not a terminal)')
+    parser.add_argument('--precount',          action='store_true',
+                        help='with --progress: count the files to add in '
+                             'the background to give an ETA for folders '
+                             'which have not been indexed before')
+    parser.add_argument('--stats',             action='store_true',
+                        help='print times and counters of the run as JSON '
+                             'to stderr')
+    parser.add_argument('--profile',           metavar='FILE',
+                        help='run with cProfile and write the statistics '
+                             'to FILE (see `python -m pstats`)')
     parser.add_argument('COMMAND')
     parser.add_argument('PATH', nargs='*')
 
-    args = parser.parse_args()
+    args = parser.parse_intermixed_args()
 
     if args.debug:
         global DEBUG_MODE
@@ -721,42 +3450,98 @@ def main():
     if args.rebuild:
         clear_index(args.storage_dir)
 
+    _stats = run_stats() if args.stats else None
+
+    def open_indexer(**kwargs):
+        return indexer(args.storage_dir, args.backend,
+                       hash_algorithm=args.hash, stats=_stats, **kwargs)
+
+    if args.profile:
+        import cProfile
+        _profile = cProfile.Profile()
+        _profile.enable()
+    _start = time.perf_counter()
+
     try:
         if args.COMMAND == 'clear':
             clear_index(args.storage_dir)
 
         elif args.COMMAND == 'info':
-            with indexer(args.storage_dir) as _indexer:
+            with open_indexer() as _indexer:
+                print('hash algorithm:', _indexer.hash_algorithm())
                 print('indexed directories:')
                 for i in _indexer.tracked_dir_list():
                     print("  ", i)
 
         elif args.COMMAND == 'add':
-            with indexer(args.storage_dir) as _indexer:
-                for p in args.PATH:
-                    logging.info("ADD to index: '%s'", p)
-                    _indexer.add(p)
-
-        elif args.COMMAND == 'check-dups':
-            with indexer(args.storage_dir) as _indexer:
-                logging.info("check four duplicates in '%s'", args.PATH[0])
-                for d in args.PATH:
-                    _indexer.check_redundancy(d, invert=args.invert)
-
-        elif args.COMMAND == 'check-redundancy':
-            with indexer(args.storage_dir) as _indexer:
-                logging.info("check four duplicates in '%s'", args.PATH[0])
-                for d in args.PATH:
-                    _indexer.check_redundancy(d, invert=True)
-
-        elif args.COMMAND == 'diff':
-            if len(args.PATH) != 2:
+            with open_indexer(jobs=args.jobs, walkers=args.walkers,
+                              write_buffer=args.write_buffer,
+                              flush_interval=args.flush_interval) as _indexer:
+                _paths = args.PATH
+                if args.resume and not _paths:
+                    _paths = _indexer.interrupted_paths()
+                if _paths:
+                    logging.info("ADD to index: %s",
+                                 ', '.join("'%s'" % p for p in _paths))
+                    _indexer.add_paths(_paths, resume=args.resume,
+                                       progress=progress_reporter()
+                                       if args.progress else None,
+                                       precount=args.precount)
+
+        elif args.COMMAND == 'watch':
+            with open_indexer(jobs=args.jobs, walkers=args.walkers,
+                              write_buffer=args.write_buffer,
+                              flush_interval=args.flush_interval) as _indexer:
+                _indexer.watch()
+
+        elif args.COMMAND == 'export-names':
+            if len(args.PATH) != 1:
+                raise parser.error("please provide the file to write to")
+            with open_indexer() as _indexer:
+                _indexer.export_names(args.PATH[0])
+
+        elif args.COMMAND == 'gc':
+            with open_indexer() as _indexer:
+                _result = _indexer.gc(budget=args.time_budget)
+            print('checked %d entries: removed %d of vanished or changed '
+                  'files, %d sizes left with a single file, %d empty '
+                  'directories' % (
+                      _result['checked'], _result['removed'],
+                      _result['collapsed'], _result['directories_removed']))
+            if _result['bytes_before'] is not None:
+                print('index size: %s -> %s bytes' % (
+                    '{0:,}'.format(_result['bytes_before']),
+                    '{0:,}'.format(_result['bytes_after'])))
+            if not _result['complete']:
+                print('time budget used up - run `fsi gc` again to continue')
+
+        elif args.COMMAND == 'migrate':
+            with open_indexer() as _indexer:
+                _indexer.migrate()
+
+        elif args.COMMAND in QUERY_COMMANDS:
+            if args.COMMAND == 'diff' and len(args.PATH) != 2:
                 raise parser.error(
                     "please provide exactly 2 directories to compare")
-            with indexer(args.storage_dir) as _indexer:
-                logging.info("DIFF directories '%s' and '%s'",
-                             args.PATH[0], args.PATH[1])
-                _indexer.diff(args.PATH[0], args.PATH[1])
+            _request = {'command': args.COMMAND,
+                        'paths': [os.path.realpath(p) for p in args.PATH],
+                        'invert': args.invert,
+                        'from_index': args.from_index,
+                        'verify': args.verify,
+                        'ignore_names': args.ignore_names,
+                        'format': args.format}
+            # a running `fsi serve` answers without loading the index
+            _output = (None if args.no_daemon else
+                       query_daemon(daemon_socket(args.storage_dir), _request))
+            if _output is not None:
+                sys.stdout.write(_output)
+            else:
+                with open_indexer(walkers=args.walkers) as _indexer:
+                    run_query(_indexer, _request)
+
+        elif args.COMMAND == 'serve':
+            with open_indexer(walkers=args.walkers) as _indexer:
+                _indexer.serve(daemon_socket(args.storage_dir))
         else:
             pass
 
@@ -764,8 +3549,36 @@ def main():
         print("aborted")
 
     except not_indexed_error as ex:
-        print('file "%s" is not up to date - please re-index the '
-              'according folder using `fsi add`' % ex.file_info.path())
+        print('"%s" is not up to date - please re-index the according '
+              'folder using `fsi add`' % ex.path())
+
+    except index_format_error as ex:
+        print('cannot open index: %s' % ex.message)
+
+    except watch_error as ex:
+        print('cannot watch: %s' % ex.message)
+
+    except index_busy_error as ex:
+        print('cannot access index: %s' % ex.message)
+
+    except sqlite3.OperationalError as ex:
+        if not _is_busy_error(ex):
+            raise
+        print('cannot access index: the index is in use by another '
+              'process (%s)' % ex)
+
+    except daemon_error as ex:
+        print('daemon: %s' % ex.message)
+
+    finally:
+        if args.profile:
+            _profile.disable()
+            _profile.dump_stats(args.profile)
+        if _stats is not None:
+            _stats.add_time('total', time.perf_counter() - _start)
+            json.dump(dict(_stats.as_dict(), command=args.COMMAND),
+                      sys.stderr, indent=2, sort_keys=True)
+            sys.stderr.write('\n')
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
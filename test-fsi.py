@@ -63,5 +63,924 @@ def test_fsi():
             result = i.add(_test_fs)
             assert result['file_count'] == 3
 
+        with fsi.indexer(storage_dir=_storage_dir) as i:
+            assert i.tracked_dir_list() == [os.path.realpath(_test_fs)]
+            assert os.path.isfile(os.path.join(_storage_dir, 'index.sqlite'))
+
+def test_migrate(tmpdir):
+    import fsi
+    _storage_dir = str(tmpdir.join('storage'))
+    _size_dir = os.path.join(_storage_dir, 'sizes', '8')
+    fsi.make_dirs(_size_dir)
+    fsi.make_dirs(os.path.join(_storage_dir, 'sizes', '9'))
+    # layout as written by the directory based index: /a/x and /a/y share
+    # size and content, /b is the only file with 9 bytes
+    open(os.path.join(_storage_dir, 'sizes', '9', 'dirinfo'), 'w').write(
+        'single 3')
+    open(os.path.join(_size_dir, 'dirinfo'), 'w').write('multi')
+    open(os.path.join(_size_dir, 'abc'), 'w').write('0.1 10\n0.2 11\n')
+    os.symlink('abc', os.path.join(_size_dir, '0.1'))
+    os.symlink('abc', os.path.join(_size_dir, '0.2'))
+    fsi.dump_json({'a': 0, 'x': 1, 'y': 2, 'b': 3},
+                  os.path.join(_storage_dir, 'name_parts.txt'))
+    fsi.dump_json(['/a', '/b'], os.path.join(_storage_dir, 'tracked_dirs'))
+
+    with fsi.indexer(storage_dir=_storage_dir) as i:
+        assert i.migrate() == 3
+        assert i._backend.size_state(9) == ('single', (0, 3))
+        assert i._backend.size_state(8) == ('multi', None)
+        assert i._backend.references(8, 'abc') == {(1, 1): '10', (1, 2): '11'}
+    assert not os.path.exists(os.path.join(_storage_dir, 'sizes'))
+    assert not os.path.exists(os.path.join(_storage_dir, 'name_parts.txt'))
+
+def test_name_component_store(tmpdir):
+    import fsi
+    _filename = str(tmpdir.join('names'))
+    _store = fsi.indexer.name_component_store()
+    assert [_store._get_index(n, False)
+            for n in ('home', 'user', 'file')] == [0, 1, 2]
+    _store.save(_filename)
+    assert [_store._get_index(n, False)
+            for n in ('home', 'other', 'file')] == [0, 3, 2]
+    _store.save(_filename)
+    assert open(_filename, 'rb').read() == b'home\0user\0file\0other\0'
+
+    # a record torn by a crash gets ignored and overwritten
+    open(_filename, 'ab').write(b'tor')
+    _loaded = fsi.indexer.name_component_store()
+    _loaded.load(_filename)
+    assert _loaded == _store
+    assert _loaded._get_index('x', False) == 4
+    _loaded.save(_filename)
+
+    # words added by another process get loaded incrementally
+    _store.load(_filename)
+    assert _store[4] == 'x'
+
+def test_directory_table(tmpdir):
+    import fsi
+    _test_fs = tmpdir.join('test_fs')
+    for name in ('a/x/1', 'a/y/2', 'ab/3', 'b/4'):
+        _test_fs.join(*name.split('/')).write(name, ensure=True)
+
+    with fsi.indexer(storage_dir=str(tmpdir.join('storage'))) as i:
+        i.add(str(_test_fs))
+        _dirs = i._directories
+        _a = _dirs.node(str(_test_fs.join('a')))
+        _ab = _dirs.node(str(_test_fs.join('ab')))
+        _key = _dirs.key(str(_test_fs.join('a', 'y', '2')), const=True)
+        assert _dirs.restore(_key) == str(_test_fs.join('a', 'y', '2'))
+        assert _dirs.is_below(_key[0], _a)
+        assert _dirs.is_below(_a, _a)
+        assert not _dirs.is_below(_key[0], _ab)
+        assert not _dirs.is_below(_a, _key[0])
+        _node_count = len(_dirs)
+
+    # numbering and nodes survive reopening, new nodes get numbered too
+    _test_fs.join('a', 'z', '5').write('5', ensure=True)
+    with fsi.indexer(storage_dir=str(tmpdir.join('storage'))) as i:
+        assert len(i._directories) == _node_count
+        _a = i._directories.node(str(_test_fs.join('a')), const=True)
+        _numbered = []
+        _store_numbering = i._backend.store_numbering
+        def _recording_store_numbering(rows):
+            rows = list(rows)
+            _numbered.extend(r[2] for r in rows)
+            _store_numbering(rows)
+        i._backend.store_numbering = _recording_store_numbering
+        i.add(str(_test_fs.join('a', 'z')))
+        _z = i._directories.node(str(_test_fs.join('a', 'z')), const=True)
+        assert i._directories.is_below(_z, _a)
+        assert not i._directories.is_below(_a, _z)
+        # the other nodes keep their numbers
+        assert _numbered == [_z]
+
+def test_diff_from_index(tmpdir):
+    import fsi
+    _test_fs = tmpdir.join('test_fs')
+    for name, content in (('a/1', 'same'), ('a/sub/2', 'only a'),
+                          ('a/3', 'gone'), ('b/x/1', 'same'),
+                          ('b/4', 'only b'), ('c/5', 'gone')):
+        _test_fs.join(*name.split('/')).write(content, ensure=True)
+    _a, _b = str(_test_fs.join('a')), str(_test_fs.join('b'))
+
+    with fsi.indexer(storage_dir=str(tmpdir.join('storage'))) as i:
+        i.add(str(_test_fs))
+        _walked = i.diff(_a, _b)
+        _indexed = i.diff(_a, _b, from_index=True)
+        assert ([[f.path() for f in r] for r in _indexed] ==
+                [[str(_test_fs.join('b', '4'))],
+                 [str(_test_fs.join('a', '3')),
+                  str(_test_fs.join('a', 'sub', '2'))]])
+        assert ([sorted(f.path() for f in r) for r in _walked] ==
+                [[f.path() for f in r] for r in _indexed])
+
+        # only the result gets verified against the filesystem
+        _test_fs.join('a', '3').remove()
+        assert [len(r) for r in i.diff(_a, _b, from_index=True)] == [1, 1]
+
+def test_redundancy_from_index(tmpdir):
+    import fsi
+    _test_fs = tmpdir.join('test_fs')
+    for name, content in (('a/1', 'copied'), ('a/sub/2', 'only a'),
+                          ('a/3', 'twice in a'), ('a/sub/4', 'twice in a'),
+                          ('b/1', 'copied'), ('c/1', 'copied')):
+        _test_fs.join(*name.split('/')).write(content, ensure=True)
+    _a = str(_test_fs.join('a'))
+
+    def _paths(result):
+        return {f.path(): v and sorted(i._directories.restore(k) for k in v)
+                for f, v in result.items()}
+
+    with fsi.indexer(storage_dir=str(tmpdir.join('storage'))) as i:
+        i.add(str(_test_fs))
+        for invert in (False, True):
+            _walked = _paths(i.check_redundancy(_a, invert=invert))
+            assert _walked == _paths(i.check_redundancy(
+                _a, invert=invert, from_index=True))
+        assert _walked == {str(_test_fs.join(*p.split('/'))): None
+                           for p in ('a/3', 'a/sub/2', 'a/sub/4')}
+        assert _paths(i.check_redundancy(_a, from_index=True)) == {
+            str(_test_fs.join('a', '1')): [str(_test_fs.join('b', '1')),
+                                           str(_test_fs.join('c', '1'))]}
+
+        # copies which vanished only count without --verify
+        _test_fs.join('b', '1').remove()
+        _test_fs.join('c', '1').remove()
+        assert len(i.check_redundancy(_a, from_index=True)) == 1
+        assert len(i.check_redundancy(_a, from_index=True, verify=True)) == 0
+        assert len(i.check_redundancy(
+            _a, invert=True, from_index=True, verify=True)) == 4
+
+def test_streamed_results(tmpdir, capsys):
+    import fsi, json
+    _test_fs = tmpdir.join('test_fs')
+    for name, content in (('a/1', 'copied'), ('a/2', 'only a'),
+                          ('b/1', 'copied'), ('b/3', 'only b')):
+        _test_fs.join(*name.split('/')).write(content, ensure=True)
+    _a, _b = str(_test_fs.join('a')), str(_test_fs.join('b'))
+
+    with fsi.indexer(storage_dir=str(tmpdir.join('storage'))) as i:
+        i.add(str(_test_fs))
+        for from_index in (False, True):
+            assert [(d, f.path()) for d, f in i.iter_diff(
+                _a, _b, from_index=from_index)] == [
+                    (_a, str(_test_fs.join('a', '2'))),
+                    (_b, str(_test_fs.join('b', '3')))]
+            assert [(f.path(), c, l) for f, c, l in i.iter_redundancy(
+                _a, from_index=from_index)] == [
+                    (str(_test_fs.join('a', '1')),
+                     [str(_test_fs.join('b', '1'))], [])]
+
+        capsys.readouterr()
+        for command in ('diff', 'check-dups', 'check-redundancy'):
+            fsi.run_query(i, {
+                'command': command, 'format': 'jsonl',
+                'paths': [_a, _b] if command == 'diff' else [_a]})
+        _records = capsys.readouterr().out.splitlines()
+        assert [json.loads(l) for l in _records] == [
+            {'only_in': _a, 'path': str(_test_fs.join('a', '2'))},
+            {'only_in': _b, 'path': str(_test_fs.join('b', '3'))},
+            {'path': str(_test_fs.join('a', '1')),
+             'copies': [str(_test_fs.join('b', '1'))], 'same_inode': []},
+            {'path': str(_test_fs.join('a', '2'))}]
+
+def test_unindexed_directory(tmpdir, capsys, monkeypatch):
+    import fsi, sys
+    _test_fs = tmpdir.join('test_fs')
+    _test_fs.join('a', '1').write('content', ensure=True)
+    _test_fs.join('b', '1').write('content', ensure=True)
+    _a, _b = str(_test_fs.join('a')), str(_test_fs.join('b'))
+    _storage_dir = str(tmpdir.join('storage'))
+    with fsi.indexer(storage_dir=_storage_dir) as i:
+        i.add(_a)
+
+    for command in (['diff', _a, _b], ['check-dups', _b], ['dup-dirs', _b],
+                    ['--from-index', 'check-redundancy', _b]):
+        monkeypatch.setattr(sys, 'argv', [
+            'fsi', '-s', _storage_dir, '--no-daemon'] + command)
+        fsi.main()
+        assert ('"%s" is not up to date' % _b) in capsys.readouterr().out
+
+    # options may follow the command and its paths
+    for command in (['add', '--resume', _b], ['check-dups', _b, '--no-daemon']):
+        monkeypatch.setattr(sys, 'argv', ['fsi', '-s', _storage_dir] + command)
+        fsi.main()
+    assert 'not up to date' not in capsys.readouterr().out
+
+def test_stats(tmpdir):
+    import fsi
+    _test_fs = tmpdir.join('test_fs')
+    _test_fs.join('a').write('content1', ensure=True)
+    _test_fs.join('b').write('content1')
+    _test_fs.join('empty').write('')
+    _test_fs.join('.git', 'c').write('content1', ensure=True)
+
+    with fsi.indexer(storage_dir=str(tmpdir.join('storage')),
+                     stats=fsi.run_stats()) as i:
+        i.add(str(_test_fs))
+        _stats = i.stats()
+        assert _stats['counts']['files'] == 2
+        assert _stats['counts']['hashes'] == 2
+        assert _stats['counts']['bytes_hashed'] == 16
+        assert _stats['counts']['skipped_empty'] == 1
+        assert _stats['counts']['skipped_ignored'] == 1
+        assert _stats['counts']['index_size_state'] == 2
+        assert _stats['seconds']['hash'] > 0
+        assert _stats['seconds']['index_write'] > 0
+
+def test_hardlinks(tmpdir):
+    import os
+    import fsi
+    _test_fs = tmpdir.join('test_fs')
+    _test_fs.join('copy', 'a').write('content1', ensure=True)
+    for name, content in (('a', 'content1'), ('b', 'content2'),
+                          ('c', 'other')):
+        _test_fs.join('snap1', name).write(content, ensure=True)
+        _test_fs.join('snap2').ensure(dir=True)
+        os.link(str(_test_fs.join('snap1', name)),
+                str(_test_fs.join('snap2', name)))
+
+    def _path(*names):
+        return str(_test_fs.join(*names))
+
+    with fsi.indexer(storage_dir=str(tmpdir.join('storage')),
+                     stats=fsi.run_stats()) as i:
+        i.add(str(_test_fs))
+        # every inode gets hashed once - snap2/a and snap2/b reuse the
+        # hashes in the index, snap2/c the one just computed for snap1/c
+        _counts = i.stats()['counts']
+        assert _counts['hashes'] == 4
+        assert _counts['hashes_reused'] == 3
+        assert _counts['bytes_hashed'] == 3 * 8 + 5
+
+        # hardlinks are reported apart from real copies
+        for from_index in (False, True):
+            assert sorted(
+                (f.path(), c, l) for f, c, l in i.iter_redundancy(
+                    _path('snap1'), from_index=from_index)) == [
+                        (_path('snap1', 'a'), [_path('copy', 'a')],
+                         [_path('snap2', 'a')]),
+                        (_path('snap1', 'b'), [], [_path('snap2', 'b')]),
+                        (_path('snap1', 'c'), [], [_path('snap2', 'c')])]
+
+def test_duplicate_directories(tmpdir):
+    import fsi
+    _test_fs = tmpdir.join('test_fs')
+    for name, content in (('a', 'p1'), ('b', 'p2'), ('sub/c', 'p3')):
+        _test_fs.join('photos', *name.split('/')).write(content, ensure=True)
+        _test_fs.join('backup', '2023', 'photos', *name.split('/')).write(
+            content, ensure=True)
+    for name, content in (('x', 'p1'), ('y', 'p2'), ('s/z', 'p3')):
+        _test_fs.join('renamed', 'pics', *name.split('/')).write(
+            content, ensure=True)
+    _test_fs.join('unique').write('only once')
+
+    def _paths(*names):
+        return [str(_test_fs.join(*n.split('/'))) for n in names]
+
+    with fsi.indexer(storage_dir=str(tmpdir.join('storage'))) as i:
+        i.add(str(_test_fs))
+        # photos/sub is only identical because photos is
+        assert i.duplicate_directories() == [
+            _paths('backup/2023/photos', 'photos')]
+        assert i.duplicate_directories(ignore_names=True) == [
+            _paths('backup/2023', 'renamed'),
+            _paths('backup/2023/photos', 'photos', 'renamed/pics')]
+        assert i.duplicate_directories(str(_test_fs.join('photos'))) == [
+            _paths('backup/2023/photos', 'photos')]
+        assert i.duplicate_directories(str(_test_fs.join('renamed'))) == []
+
+        # digests get updated on add
+        _test_fs.join('photos', 'new').write('p4')
+        i.add(str(_test_fs.join('photos')))
+        assert i.duplicate_directories() == [
+            _paths('backup/2023/photos/sub', 'photos/sub')]
+
+        # diff doesn't descend into identical subtrees
+        _listed = []
+        _list_directory = i._list_directory
+
+        def _recording_list_directory(directory):
+            _listed.append(directory)
+            return _list_directory(directory)
+
+        i._list_directory = _recording_list_directory
+        assert [[f.path() for f in r] for r in i.diff(
+            str(_test_fs.join('photos')),
+            str(_test_fs.join('backup')))] == [[], _paths('photos/new')]
+        assert _listed == _paths('photos', 'backup', 'backup/2023',
+                                 'backup/2023/photos')
+
+def test_diff_emptied_directories(tmpdir):
+    import fsi
+    import pytest
+    _test_fs = tmpdir.join('test_fs')
+    for name in ('a/x/1', 'a/2', 'b/z/3', 'b/4'):
+        _test_fs.join(*name.split('/')).write(name, ensure=True)
+
+    with fsi.indexer(storage_dir=str(tmpdir.join('storage'))) as i:
+        i.add(str(_test_fs))
+        # the files of a/x and b/z get removed (e.g. by `fsi watch`)
+        with i._add_lock():
+            for name in ('a/x/1', 'b/z/3'):
+                _test_fs.join(*name.split('/')).remove()
+                i._update_file(str(_test_fs.join(*name.split('/'))))
+            i._update_directory_digests()
+        # directories without indexed files are not identical
+        _test_fs.join('a', 'x', 'new').write('new file')
+        with pytest.raises(fsi.not_indexed_error):
+            i.diff(str(_test_fs.join('a')), str(_test_fs.join('b')))
+
+def test_progress(tmpdir):
+    import io
+    import json
+    import threading
+    import fsi
+    _test_fs = tmpdir.join('test_fs')
+    for i in range(10):
+        _test_fs.join('file%d' % i).write('content%d' % i, ensure=True)
+
+    _output = io.StringIO()
+    with fsi.indexer(storage_dir=str(tmpdir.join('storage'))) as i:
+        i.add(str(_test_fs), progress=fsi.progress_reporter(
+            _output, interval=0))
+    _lines = [json.loads(l) for l in _output.getvalue().splitlines()]
+    assert [l['files'] for l in _lines] == list(range(1, 11)) + [10]
+    # nothing known from an earlier run - no ETA
+    assert _lines[0]['eta_s'] is None
+    assert _lines[-1]['bytes'] == 80
+
+    _test_fs.join('file10').write('content10')
+    _output = io.StringIO()
+    with fsi.indexer(storage_dir=str(tmpdir.join('storage'))) as i:
+        i.add(str(_test_fs), progress=fsi.progress_reporter(
+            _output, interval=0))
+    _lines = [json.loads(l) for l in _output.getvalue().splitlines()]
+    assert _lines[0]['eta_s'] is not None
+
+    # for a first run the files can be counted in the background
+    _stop = threading.Event()
+    with fsi.indexer(storage_dir=str(tmpdir.join('storage2'))) as i:
+        assert i._count_files([str(_test_fs)], _stop) == 11
+        _output = io.StringIO()
+        i.add(str(_test_fs), progress=fsi.progress_reporter(
+            _output, interval=0), precount=True)
+        assert json.loads(_output.getvalue().splitlines()[-1])['files'] == 11
+        _stop.set()
+        assert i._count_files([str(_test_fs)], _stop) is None
+    _output = io.StringIO()
+    _progress = fsi.progress_reporter(_output, interval=0)
+    _progress.start()
+    _progress.expect_files(11)
+    _progress.update(5, 40)
+    assert json.loads(_output.getvalue())['eta_s'] is not None
+
+def test_resume(tmpdir):
+    import fsi
+    import pytest
+    _test_fs = tmpdir.join('test_fs')
+    for name in ('a/1', 'a/b/2', 'a/b/3', 'a/c/4', 'a/d/5', 'e/6', '7'):
+        _test_fs.join(*name.split('/')).write(name, ensure=True)
+    _storage_dir = str(tmpdir.join('storage'))
+
+    _added = []
+    def _interrupting_add_file(self, file_instance):
+        if len(_added) == 3:
+            raise KeyboardInterrupt()
+        _added.append(file_instance.path())
+        _add_file(self, file_instance)
+    _add_file = fsi.indexer._add_file
+
+    fsi.indexer._add_file = _interrupting_add_file
+    try:
+        with pytest.raises(KeyboardInterrupt):
+            with fsi.indexer(storage_dir=_storage_dir) as i:
+                i.add(str(_test_fs), checkpoint_interval=0)
+    finally:
+        fsi.indexer._add_file = _add_file
+    assert _added == [str(_test_fs.join(*p.split('/')))
+                      for p in ('7', 'a/1', 'a/b/2')]
+
+    with fsi.indexer(storage_dir=_storage_dir) as i:
+        assert i.interrupted_add() == str(_test_fs)
+        assert len(_index_content(i)) == 3
+        result = i.add(str(_test_fs), resume=True)
+        assert result['file_count'] == 4
+        assert i.interrupted_add() is None
+        _resumed = _index_content(i)
+
+    with fsi.indexer(storage_dir=str(tmpdir.join('storage2'))) as i:
+        i.add(str(_test_fs))
+        assert _index_content(i) == _resumed
+
+def test_resume_after_kill(tmpdir):
+    import sys
+    import subprocess
+    import fsi
+    _test_fs = tmpdir.join('test_fs')
+    for name in ('a/1', 'a/2', 'b/3', 'b/4', 'c/5'):
+        _test_fs.join(*name.split('/')).write(name, ensure=True)
+    _storage_dir = str(tmpdir.join('storage'))
+
+    # the first add gets killed without any cleanup
+    subprocess.run([sys.executable, '-c', '''if True:
+        import os, fsi
+        _added = []
+        _add_file = fsi.indexer._add_file
+        def _killing_add_file(self, file_instance):
+            if len(_added) == 3:
+                os._exit(1)
+            _added.append(file_instance)
+            _add_file(self, file_instance)
+        fsi.indexer._add_file = _killing_add_file
+        with fsi.indexer(storage_dir=%r) as i:
+            i.add(%r, checkpoint_interval=0)
+        ''' % (_storage_dir, str(_test_fs))],
+        cwd=os.path.dirname(os.path.abspath(fsi.__file__)), check=False)
+
+    with fsi.indexer(storage_dir=_storage_dir) as i:
+        assert i.interrupted_add() == str(_test_fs)
+        assert i.tracked_dir_list() == [str(_test_fs)]
+        assert i.add(str(_test_fs), resume=True)['file_count'] == 2
+        assert len(_index_content(i)) == 5
+
+def test_add_devices(tmpdir):
+    import os
+    import shutil
+    import tempfile
+    import threading
+    import pytest
+    import fsi
+    if (not os.path.isdir('/dev/shm') or
+            os.stat('/dev/shm').st_dev == os.stat(str(tmpdir)).st_dev):
+        pytest.skip('needs a second device')
+    _a = tmpdir.join('a')
+    _b = tempfile.mkdtemp(dir='/dev/shm')
+    try:
+        for name, content in (('1', 'same'), ('2', 'only a')):
+            _a.join('sub', name).write(content, ensure=True)
+        for name, content in (('1', 'same'), ('3', 'only b')):
+            with open(os.path.join(_b, name), 'w') as _f:
+                _f.write(content)
+
+        _listing_threads = set()
+        _list_directory = fsi.indexer._list_directory
+
+        def _recording_list_directory(self, directory):
+            _listing_threads.add(threading.current_thread())
+            return _list_directory(self, directory)
+
+        _threads = threading.active_count()
+        fsi.indexer._list_directory = _recording_list_directory
+        try:
+            with fsi.indexer(storage_dir=str(tmpdir.join('storage')),
+                             jobs=2) as i:
+                _result = i.add_paths([str(_a), _b])
+                # one walking thread per device
+                assert len(_listing_threads) == 2
+                assert threading.main_thread() not in _listing_threads
+                assert _result['file_count'] == 4
+                assert i.is_backed_up(str(_a.join('sub', '1'))) == [
+                    os.path.join(_b, '1')]
+        finally:
+            fsi.indexer._list_directory = _list_directory
+
+        # an interrupted add stops the walking threads and can be resumed
+        def _interrupting_add_file(self, file_instance):
+            raise KeyboardInterrupt()
+        _add_file = fsi.indexer._add_file
+        _b2 = os.path.join(_b, 'new')
+        os.mkdir(_b2)
+        with open(os.path.join(_b2, '4'), 'w') as _f:
+            _f.write('new')
+        fsi.indexer._add_file = _interrupting_add_file
+        try:
+            with pytest.raises(KeyboardInterrupt):
+                with fsi.indexer(storage_dir=str(tmpdir.join('storage'))) as i:
+                    i.add_paths([str(_a), _b], checkpoint_interval=0)
+        finally:
+            fsi.indexer._add_file = _add_file
+        assert threading.active_count() == _threads
+        with fsi.indexer(storage_dir=str(tmpdir.join('storage'))) as i:
+            assert sorted(i.interrupted_paths()) == sorted([_b, str(_a)])
+            i.add_paths(i.interrupted_paths(), resume=True)
+            assert i.interrupted_paths() == []
+            assert len(_index_content(i)) == 5
+    finally:
+        shutil.rmtree(_b)
+
+def test_recover_unknown_names(tmpdir, caplog):
+    import fsi
+    import fcntl
+    _test_fs = tmpdir.join('test_fs')
+    _test_fs.join('a', '1').write('1', ensure=True)
+    _storage_dir = str(tmpdir.join('storage'))
+    with fsi.indexer(storage_dir=_storage_dir) as i:
+        i.add(str(_test_fs))
+        _test_fs.join('b', '2').write('2', ensure=True)
+        i.add(str(_test_fs.join('b')))
+        _names = len(i._name_component_store)
+
+    # simulate a crash before the names of the last add have been written
+    _name_file = os.path.join(_storage_dir, 'name_parts.dat')
+    _content = open(_name_file, 'rb').read()
+    open(_name_file, 'wb').write(_content[:_content.rindex(b'b\0')])
+    with fsi.indexer(storage_dir=_storage_dir) as i:
+        i._backend.set_meta('add_journal', '{"path": "/", "position": null}')
+        i._backend.commit()
+
+    # an add which is still running must not be taken for an interrupted one
+    with open(os.path.join(_storage_dir, 'add.lock'), 'a') as _lock:
+        fcntl.flock(_lock, fcntl.LOCK_EX)
+        with fsi.indexer(storage_dir=_storage_dir) as i:
+            assert i._add_running()
+        assert 'interrupted' not in caplog.text
+    # reading doesn't repair the index, the next add does
+    with fsi.indexer(storage_dir=_storage_dir) as i:
+        assert not i._add_running()
+        assert i.interrupted_add() == '/'
+    assert 'interrupted' in caplog.text
+    with fsi.indexer(storage_dir=_storage_dir) as i:
+        i.add(str(_test_fs.join('a')))
+        assert len(i._name_component_store) < _names
+        assert ([c[0] for c in _index_content(i)] ==
+                [str(_test_fs.join('a', '1'))])
+
+def test_watch(tmpdir):
+    import sys
+    import pytest
+    import fsi
+    if not sys.platform.startswith('linux'):
+        pytest.skip('inotify is only available on Linux')
+    _test_fs = tmpdir.join('test_fs')
+    _test_fs.join('a', '1').write('1', ensure=True)
+    _test_fs.join('a', '2').write('2')
+    _test_fs.join('b', '3').write('3', ensure=True)
+
+    def _paths(indexer):
+        return [c[0][len(str(_test_fs)):] for c in _index_content(indexer)]
+
+    with fsi.indexer(storage_dir=str(tmpdir.join('storage'))) as i:
+        i.add(str(_test_fs))
+        with fsi.inotify_watcher() as _watcher:
+            i._watch_tree(_watcher, str(_test_fs))
+            assert len(_watcher) == 3
+            _test_fs.join('a', '1').write('changed')
+            _test_fs.join('a', '2').remove()
+            _test_fs.join('a', 'new').write('new')
+            _test_fs.join('b').remove()
+            _test_fs.join('c', 'd', '4').write('4', ensure=True)
+            _events = []
+            for _ in range(10):
+                _events.extend(_watcher.read_events(timeout=0.1))
+            i._apply_events(_watcher, _events)
+            assert _paths(i) == ['/a/1', '/a/new', '/c/d/4']
+            assert len(_watcher) == 4
+
+            # files deep inside new directories are watched, too
+            _test_fs.join('c', 'd', '5').write('5')
+            i._apply_events(_watcher, _watcher.read_events(timeout=1))
+            assert _paths(i) == ['/a/1', '/a/new', '/c/d/4', '/c/d/5']
+
+            # lost events result in a rescan which drops removed files, too
+            _test_fs.join('c', '6').write('6')
+            _test_fs.join('c', 'd', '5').remove()
+            i._apply_events(_watcher, [(None, _watcher.IN_Q_OVERFLOW)])
+            assert _paths(i) == ['/a/1', '/a/new', '/c/6', '/c/d/4']
+
+def test_serve(tmpdir):
+    import threading
+    import pytest
+    import fsi
+    _test_fs = tmpdir.join('test_fs')
+    _test_fs.join('a', '1').write('copied', ensure=True)
+    _test_fs.join('a', '2').write('unique')
+    _test_fs.join('b', '1').write('copied', ensure=True)
+    _storage_dir = str(tmpdir.join('storage'))
+    _socket = fsi.daemon_socket(_storage_dir)
+    with fsi.indexer(storage_dir=_storage_dir) as i:
+        i.add(str(_test_fs))
+
+    _stop, _ready = threading.Event(), threading.Event()
+    def _serve():
+        with fsi.indexer(storage_dir=_storage_dir) as i:
+            i.serve(_socket, _stop, _ready)
+    _thread = threading.Thread(target=_serve)
+    _thread.start()
+    try:
+        assert _ready.wait(5)
+        _request = {'command': 'is-backed-up',
+                    'paths': [str(_test_fs.join('a', '1')),
+                              str(_test_fs.join('a', '2'))]}
+        assert fsi.query_daemon(_socket, _request).splitlines() == [
+            '%s: 1 copies' % _test_fs.join('a', '1'),
+            '   %s' % _test_fs.join('b', '1'),
+            '%s: no copy' % _test_fs.join('a', '2')]
+
+        # changes made by other processes get picked up
+        _test_fs.join('c', 'd', '2').write('unique', ensure=True)
+        with fsi.indexer(storage_dir=_storage_dir) as i:
+            i.add(str(_test_fs.join('c')))
+        assert '1 copies' in fsi.query_daemon(_socket, {
+            'command': 'is-backed-up',
+            'paths': [str(_test_fs.join('a', '2'))]})
+        assert 'only in' in fsi.query_daemon(_socket, {
+            'command': 'diff', 'from_index': True,
+            'paths': [str(_test_fs.join('a')), str(_test_fs.join('b'))]})
+
+        _test_fs.join('a', '2').write('modified')
+        with pytest.raises(fsi.not_indexed_error):
+            fsi.query_daemon(_socket, _request)
+        # broken requests get an error instead of no answer at all
+        with pytest.raises(fsi.daemon_error):
+            fsi.query_daemon(_socket, {'command': 'diff', 'paths': ['/a']})
+    finally:
+        _stop.set()
+        _thread.join()
+    assert not os.path.exists(_socket)
+    assert fsi.query_daemon(_socket, _request) is None
+
+def _index_content(indexer):
+    return sorted(
+        (indexer._directories.restore(k), s, h)
+        for k, s, h in indexer._backend.all_entries())
+
+def test_parallel_hashing(tmpdir):
+    import fsi
+    _test_fs = tmpdir.join('test_fs')
+    for i in range(40):
+        # 4 different sizes, 8 different contents
+        _test_fs.join('dir%d' % (i % 3), 'file%d' % i).write(
+            'content%d' % (i % 8) * (i % 4 + 1), ensure=True)
+
+    _content = []
+    for jobs in (1, 4):
+        _storage_dir = str(tmpdir.join('storage%d' % jobs))
+        with fsi.indexer(storage_dir=_storage_dir, jobs=jobs) as i:
+            assert i.add(str(_test_fs))['file_count'] == 40
+            _content.append(_index_content(i))
+    assert _content[0] == _content[1]
+
+def test_prefetch_promotion(tmpdir):
+    import fsi
+    _test_fs = tmpdir.join('test_fs')
+    _content = b'x' * fsi.PREFILTER_MIN_SIZE
+    _test_fs.join('a', 'file').write(_content, 'wb', ensure=True)
+    _test_fs.join('b', 'file').write(_content, 'wb', ensure=True)
+
+    with fsi.indexer(storage_dir=str(tmpdir.join('storage')), jobs=2,
+                     hash_algorithm='blake2b') as i:
+        i.add(str(_test_fs.join('a')))
+        _prefetched = []
+        _prefetch = i._hash_engine.prefetch
+        def _recording_prefetch(path, inode_signature=None):
+            _prefetched.append(path)
+            _prefetch(path, inode_signature)
+        i._hash_engine.prefetch = _recording_prefetch
+        # the indexed file and the new one have the same fingerprint - both
+        # hashes are needed
+        i.add(str(_test_fs.join('b')))
+        assert sorted(_prefetched) == [
+            str(_test_fs.join('a', 'file')), str(_test_fs.join('b', 'file'))]
+
+def test_write_behind(tmpdir):
+    import fsi
+    _test_fs = tmpdir.join('test_fs')
+    for i in range(40):
+        _test_fs.join('dir%d' % (i % 3), 'file%d' % i).write(
+            'content%d' % (i % 8) * (i % 4 + 1), ensure=True)
+
+    _content = []
+    for write_buffer in (0, 3, 1000):
+        _storage_dir = str(tmpdir.join('storage%d' % write_buffer))
+        with fsi.indexer(storage_dir=_storage_dir,
+                         write_buffer=write_buffer) as i:
+            i.add(str(_test_fs))
+            _content.append(_index_content(i))
+    assert _content[0] == _content[1] == _content[2]
+
+def test_prefilter(tmpdir):
+    import fsi
+    _test_fs = tmpdir.join('test_fs')
+    _content = b'x' * fsi.PREFILTER_MIN_SIZE
+    _test_fs.join('a').write(_content, 'wb', ensure=True)
+    _test_fs.join('b').write(_content, 'wb')
+    # same size, differs only in the middle
+    _middle = len(_content) // 2
+    _test_fs.join('c').write(
+        _content[:_middle] + b'y' + _content[_middle + 1:], 'wb')
+    _test_fs.join('d').write(b'1' + _content[1:], 'wb')
+
+    with fsi.indexer(storage_dir=str(tmpdir.join('storage'))) as i:
+        result = i.add(str(_test_fs))
+        assert result['full_hashes'] == 2
+        assert result['full_hashes_avoided'] >= 2
+        for name, duplicates in (('a', 2), ('b', 2), ('c', 1), ('d', 1)):
+            _file = fsi.file_info(str(_test_fs.join(name)), i._directories)
+            assert len(i._get_state(_file)[2]) == duplicates
+
+def test_prefilter_without_fingerprints(tmpdir):
+    import fsi
+    import sqlite3
+    _test_fs = tmpdir.join('test_fs')
+    _content = b'x' * fsi.PREFILTER_MIN_SIZE
+    _test_fs.join('a').write(_content, 'wb', ensure=True)
+    _test_fs.join('b').write(b'y' + _content[1:], 'wb')
+    _storage_dir = str(tmpdir.join('storage'))
+
+    with fsi.indexer(storage_dir=_storage_dir) as i:
+        i.add(str(_test_fs))
+    # entries from older index versions have hashes but no fingerprints
+    _db = sqlite3.connect(os.path.join(_storage_dir, 'index.sqlite'))
+    with _db:
+        _db.execute('UPDATE files SET fingerprint = NULL')
+    _db.close()
+
+    _test_fs.join('sub', 'c').write(_content, 'wb', ensure=True)
+    with fsi.indexer(storage_dir=_storage_dir) as i:
+        result = i.add(str(_test_fs.join('sub')))
+        assert result['full_hashes_avoided'] == 0
+        _file = fsi.file_info(str(_test_fs.join('sub', 'c')), i._directories)
+        assert len(i._get_state(_file)[2]) == 2
+
+def test_read_during_write(tmpdir, monkeypatch):
+    import fsi
+    import sqlite3
+    import pytest
+    _test_fs = tmpdir.join('test_fs')
+    _test_fs.join('a', 'file').write('content', ensure=True)
+    _test_fs.join('b', 'file').write('content', ensure=True)
+    _storage_dir = str(tmpdir.join('storage'))
+    with fsi.indexer(storage_dir=_storage_dir) as i:
+        i.add(str(_test_fs))
+
+    # another process is adding files
+    _writer = sqlite3.connect(os.path.join(_storage_dir, 'index.sqlite'))
+    _writer.execute('BEGIN IMMEDIATE')
+    _writer.execute("UPDATE meta SET value = value WHERE key = 'x'")
+    monkeypatch.setattr(fsi.sqlite_backend, 'busy_timeout', 0.1)
+    with fsi.indexer(storage_dir=_storage_dir) as i:
+        assert len(i.check_redundancy(str(_test_fs.join('a')))) == 1
+
+    _writer.execute('COMMIT')
+    _writer.execute('BEGIN EXCLUSIVE')
+    with pytest.raises(fsi.index_busy_error):
+        fsi.indexer(storage_dir=_storage_dir)
+    _writer.close()
+
+def test_replace_vanished_file(tmpdir):
+    import fsi
+    for size in (10, fsi.PREFILTER_MIN_SIZE):
+        _test_fs = tmpdir.join('test_fs%d' % size)
+        _dir = _test_fs.join('d')
+        _dir.join('a').write(b'a' * size, 'wb', ensure=True)
+        with fsi.indexer(storage_dir=str(tmpdir.join('storage%d' % size))) as i:
+            i.add(str(_dir))
+            # the only file of its size vanishes and another one takes
+            # its place before a copy shows up
+            _dir.join('a').remove()
+            _dir.join('b').write(b'b' * size, 'wb')
+            i.add(str(_dir))
+            _dir.join('c').write(b'b' * size, 'wb')
+            assert i.add(str(_dir))['file_count'] == 2
+            assert len(_index_content(i)) == 2
+            for name in ('b', 'c'):
+                _file = fsi.file_info(str(_dir.join(name)), i._directories)
+                assert len(i._get_state(_file)[2]) == 2
+
+def test_query_doesnt_save_names(tmpdir):
+    import fsi
+    _test_fs = tmpdir.join('test_fs')
+    _test_fs.join('a', '1').write('content1', ensure=True)
+    _test_fs.join('b', '2').write('content2', ensure=True)
+    _storage_dir = str(tmpdir.join('storage'))
+    _name_file = os.path.join(_storage_dir, 'name_parts.dat')
+    with fsi.indexer(storage_dir=_storage_dir) as i:
+        i.add(str(_test_fs))
+    _names = open(_name_file, 'rb').read()
+
+    with fsi.indexer(storage_dir=_storage_dir) as _adding:
+        _adding.add(str(_test_fs.join('a')))
+        # a query looks at a new file with a known size meanwhile
+        _test_fs.join('a', 'unknown').write('content3')
+        with fsi.indexer(storage_dir=_storage_dir) as i:
+            i.check_redundancy(str(_test_fs.join('a')))
+        assert open(_name_file, 'rb').read() == _names
+        _adding.add(str(_test_fs.join('a')))
+
+def test_incremental_add(tmpdir):
+    import fsi
+    _test_fs = tmpdir.join('test_fs')
+    _test_fs.join('a').write('content1', ensure=True)
+    _test_fs.join('b').write('content2')
+    _test_fs.join('sub', 'c').write('content1', ensure=True)
+
+    with fsi.indexer(storage_dir=str(tmpdir.join('storage'))) as i:
+        assert i.add(str(_test_fs))['unchanged'] == 0
+
+    with fsi.indexer(storage_dir=str(tmpdir.join('storage'))) as i:
+        result = i.add(str(_test_fs))
+        assert result['file_count'] == 3
+        assert result['unchanged'] == 3
+        assert result['full_hashes'] == 0
+
+        # same size, new content
+        _test_fs.join('sub', 'c').write('content2')
+        os.utime(str(_test_fs.join('sub', 'c')), (0, 0))
+        result = i.add(str(_test_fs))
+        assert result['unchanged'] == 2
+        assert result['full_hashes'] == 1
+        _file = fsi.file_info(str(_test_fs.join('b')), i._directories)
+        assert len(i._get_state(_file)[2]) == 2
+
+def test_hash_algorithm(tmpdir):
+    import fsi
+    import pytest
+    _test_fs = tmpdir.join('test_fs')
+    _test_fs.join('a').write('content1', ensure=True)
+    _test_fs.join('b').write('content1')
+    _storage_dir = str(tmpdir.join('storage'))
+
+    with fsi.indexer(storage_dir=_storage_dir, hash_algorithm='blake2b') as i:
+        i.add(str(_test_fs))
+        _file = fsi.file_info(str(_test_fs.join('a')), i._directories)
+        assert len(i._get_state(_file)[2]) == 2
+        assert len(i._backend.entry(8, _file.key())[0]) == 64
+
+    with fsi.indexer(storage_dir=_storage_dir) as i:
+        assert i.hash_algorithm() == 'blake2b'
+
+    with pytest.raises(fsi.index_format_error):
+        fsi.indexer(storage_dir=_storage_dir, hash_algorithm='sha1')
+
+def test_walk(tmpdir):
+    import fsi
+    _test_fs = tmpdir.join('test_fs')
+    _test_fs.join('b', 'file').write('content', ensure=True)
+    _test_fs.join('a', 'file').write('content', ensure=True)
+    _test_fs.join('a', 'empty').write('')
+    _test_fs.join('.git', 'file').write('content', ensure=True)
+    _test_fs.join('c').mksymlinkto(_test_fs.join('a'))
+    _test_fs.join('a', 'link').mksymlinkto(_test_fs.join('a', 'file'))
+
+    with fsi.indexer(storage_dir=str(tmpdir.join('storage'))) as i:
+        _found = []
+        i._walk(str(_test_fs), _found.append)
+        assert [f.path() for f in _found] == [
+            str(_test_fs.join('a', 'file')), str(_test_fs.join('b', 'file'))]
+        assert _found[0].size() == 7
+
+def test_parallel_walk(tmpdir):
+    import fsi
+    _test_fs = tmpdir.join('test_fs')
+    for i in range(60):
+        _test_fs.join('d%d' % (i % 7), 'e%d' % (i % 5), 'f%d' % i).write(
+            'content', ensure=True)
+    _test_fs.join('d1', '__pycache__', 'file').write('content', ensure=True)
+
+    _paths = []
+    for walkers in (1, 4):
+        with fsi.indexer(storage_dir=str(tmpdir.join('storage')),
+                         walkers=walkers) as i:
+            _found = []
+            i._walk(str(_test_fs), lambda f: _found.append(f.path()))
+            _paths.append(_found)
+    assert len(_paths[0]) == 60
+    assert _paths[0] == _paths[1]
+
+def test_gc(tmpdir):
+    import fsi
+    _test_fs = tmpdir.join('test_fs')
+    for name, content in (('a', 'same'), ('b', 'same'), ('c', 'changed'),
+                          ('sub/deep/d', 'removed'), ('sub/e', 'kept file')):
+        _test_fs.join(*name.split('/')).write(content, ensure=True)
+
+    with fsi.indexer(storage_dir=str(tmpdir.join('storage'))) as i:
+        i.add(str(_test_fs))
+        assert i._backend.size_state(4)[0] == 'multi'
+        _test_fs.join('b').remove()
+        _test_fs.join('c').write('changed!')
+        _test_fs.join('sub', 'deep').remove()
+
+        _result = i.gc()
+        assert (_result['checked'], _result['removed']) == (5, 3)
+        assert _result['collapsed'] == 1
+        assert _result['directories_removed'] == 1
+        assert _result['complete']
+        assert i._backend.size_state(4)[0] == 'single'
+        assert str(_test_fs.join('sub', 'deep')) not in [
+            i._directories.dir_path(n[0]) for n in i._backend.nodes()]
+
+        # with a time budget gc stops after one batch and continues later
+        _test_fs.join('a').remove()
+        _first = i.gc(budget=0, batch_size=1)
+        assert (_first['checked'], _first['complete']) == (1, False)
+        _second = i.gc(batch_size=1)
+        assert _second['checked'] == 1
+        assert _first['removed'] + _second['removed'] == 1
+        assert _second['complete']
+        assert i.gc()['checked'] == 1
+
 if __name__ == '__main__':
-    test_fsi()
\ No newline at end of file
+    test_fsi()